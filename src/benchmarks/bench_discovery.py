@@ -0,0 +1,188 @@
+"""
+Benchmark of container discovery and backup planning.
+
+Synthetic ``docker ps`` data is generated with the test fixtures for
+a compose project with the given numbers of containers. The mix has
+containers without labels, volume backups with and without include or
+exclude patterns, database containers, replicas of the same service,
+stopped containers and containers in other projects.
+
+Each stage is timed over a number of repeats and then run once more
+under ``tracemalloc`` to record the peak and retained allocations.
+
+Usage::
+
+    python src/benchmarks/bench_discovery.py --sizes 10,1000,10000 --output discovery.json
+"""
+import argparse
+import gc
+import hashlib
+import os
+import random
+import sys
+import time
+import tracemalloc
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tests'))
+import common  # noqa: E402
+import fixtures  # noqa: E402
+
+PROJECT = 'benchmark'
+BACKUP_ID = hashlib.sha256(b'backup').hexdigest()
+
+
+def container_id(index: int) -> str:
+    # fixtures.generate_sha256 is time based and not unique in a tight loop
+    return hashlib.sha256(b'%d' % index).hexdigest()
+
+
+def mount(kind: str, source: str, destination: str) -> dict:
+    return {'Type': kind, 'Source': source, 'Destination': destination}
+
+
+def synthetic_container(index: int, rand: random.Random, replicas: int) -> dict:
+    """A container with a random but reproducible mix of labels and mounts"""
+    from restic_compose_backup import enums
+
+    service = 'service{}'.format(index // replicas)
+    volume_root = '/var/lib/docker/volumes/{}_{}'.format(PROJECT, service)
+    mounts = [
+        mount('volume', '{}_data/_data'.format(volume_root), '/data'),
+        mount('volume', '{}_cache/_data'.format(volume_root), '/cache'),
+        mount('bind', '/srv/{}/media'.format(service), '/media'),
+        mount('bind', '/srv/{}/logs'.format(service), '/var/log/app'),
+    ][:rand.randint(1, 4)]
+    labels = {}
+
+    kind = rand.random()
+    if kind < 0.40:
+        labels[enums.LABEL_VOLUMES_ENABLED] = 'true'
+    elif kind < 0.55:
+        labels[enums.LABEL_VOLUMES_ENABLED] = 'true'
+        labels[enums.LABEL_VOLUMES_INCLUDE] = 'data,media'
+    elif kind < 0.70:
+        labels[enums.LABEL_VOLUMES_ENABLED] = 'true'
+        labels[enums.LABEL_VOLUMES_EXCLUDE] = 'cache,logs'
+    elif kind < 0.80:
+        label = rand.choice([
+            enums.LABEL_MYSQL_ENABLED,
+            enums.LABEL_MARIADB_ENABLED,
+            enums.LABEL_POSTGRES_ENABLED,
+        ])
+        labels[label] = 'true'
+        mounts = [mount('volume', '{}_db/_data'.format(volume_root), '/var/lib/db')]
+    labels['com.example.index'] = str(index)
+
+    return {
+        'id': container_id(index),
+        'service': service,
+        'labels': labels,
+        'mounts': mounts,
+    }
+
+
+def generate(size: int, seed: int, replicas: int) -> list:
+    """Generate the ``docker ps`` data for ``size`` containers"""
+    rand = random.Random(seed)
+    containers = [{'id': BACKUP_ID, 'service': 'backup'}]
+    containers.extend(synthetic_container(index, rand, replicas) for index in range(size))
+    data = fixtures.containers(project=PROJECT, containers=containers)()
+
+    # A share of stopped containers and containers in other projects
+    for item in data[1:]:
+        value = rand.random()
+        if value < 0.05:
+            item['State'] = {'Status': 'exited', 'Running': False}
+        elif value < 0.15:
+            item['Config']['Labels']['com.docker.compose.project'] = 'other'
+
+    return data
+
+
+def measure(func, repeats: int) -> dict:
+    """Best and mean wall time of ``func`` followed by a run under tracemalloc"""
+    timings = []
+    for _ in range(repeats):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+
+    gc.collect()
+    tracemalloc.start()
+    try:
+        result = func()
+        retained, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'best_seconds': min(timings),
+        'mean_seconds': sum(timings) / len(timings),
+        'peak_alloc_bytes': peak,
+        'retained_alloc_bytes': retained,
+        'items': result,
+    }
+
+
+def benchmark(args):
+    common.setup_environment()
+    os.environ['HOSTNAME'] = BACKUP_ID[:8]
+
+    from restic_compose_backup.config import config
+    from restic_compose_backup.containers import RunningContainers
+    from restic_compose_backup.plan import BackupPlan
+
+    results = []
+    for size in args.sizes:
+        data = generate(size, args.seed, args.replicas)
+        with mock.patch('restic_compose_backup.utils.list_containers', return_value=data):
+            containers = RunningContainers()
+            for_backup = containers.containers_for_backup()
+            stages = [
+                ('running_containers', lambda: len(RunningContainers().containers)),
+                ('containers_for_backup', lambda: len(containers.containers_for_backup())),
+                ('generate_backup_mounts', lambda: len(containers.generate_backup_mounts('/volumes'))),
+                ('filter_mounts', lambda: sum(len(c.filter_mounts()) for c in for_backup)),
+                ('generate_backup_units', lambda: len(
+                    containers.generate_backup_units('/volumes', config.volume_backup_split))),
+                ('backup_plan', lambda: len(BackupPlan.build(containers, config).to_json())),
+            ]
+
+            for stage, func in stages:
+                values = measure(func, args.repeats)
+                values.update({'containers': size, 'stage': stage})
+                results.append(values)
+                print(
+                    '{containers} containers {stage}: {best_seconds:.4f}s, '
+                    'peak {peak_alloc_bytes} bytes allocated'.format(**values),
+                    file=sys.stderr,
+                )
+
+    common.write_results('discovery', {
+        'sizes': args.sizes,
+        'repeats': args.repeats,
+        'replicas': args.replicas,
+        'seed': args.seed,
+        'volume_backup_split': config.volume_backup_split,
+    }, results, args.output)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument(
+        '--sizes', default='10,1000,10000',
+        type=lambda value: [int(size) for size in value.split(',')],
+        help="Comma separated numbers of containers",
+    )
+    parser.add_argument('--repeats', type=int, default=5, help="Timed runs of each stage")
+    parser.add_argument('--replicas', type=int, default=2, help="Containers per service")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Result file. Printed to stdout if not set")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    benchmark(parse_args())
@@ -0,0 +1,167 @@
+"""
+Benchmark of the dump to restic pipeline.
+
+A synthetic dump generator stands in for mysqldump / pg_dump producing
+the same rows every run except for a configurable ratio of changed rows.
+The dump is generated to a file before each run and streamed with ``cat``
+so the generator itself does not limit the throughput.
+
+Each run is piped through ``restic.backup_from_stdin`` into a local
+repository on disk. The relay scenario replaces restic with a reader
+discarding the data to measure the pipeline itself, and the stream
+scenario reads the dump with ``commands.run_stream``.
+
+Usage::
+
+    python src/benchmarks/bench_dump_pipeline.py --size-mb 256 --runs 3 --output dump.json
+
+Scenarios needing restic are skipped if the binary is not found.
+"""
+import argparse
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+from unittest import mock
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import common  # noqa: E402
+
+ROW_SIZE = 160
+# Stands in for restic in the relay scenario
+DISCARD_COMMAND = ['sh', '-c', 'cat > /dev/null']
+
+
+def generate(out, size: int, run: int, change_ratio: float, seed: int = 0):
+    """
+    Write a sql like dump of ``size`` bytes. A row changes
+    between two runs with the probability ``change_ratio``.
+    """
+    threshold = int(change_ratio * 2 ** 32)
+    out.write(b'-- synthetic dump\nCREATE TABLE data (id BIGINT PRIMARY KEY, value TEXT);\n')
+    for row in range(size // ROW_SIZE):
+        # The version of a row is the number of earlier runs changing it
+        version = sum(
+            1 for previous in range(1, run + 1)
+            if zlib.crc32(b'%d:%d:%d' % (seed, row, previous)) < threshold
+        )
+        value = hashlib.blake2b(b'%d:%d:%d' % (seed, row, version), digest_size=64).hexdigest()
+        out.write(b"INSERT INTO data VALUES (%d, '%s');\n" % (row, value[:ROW_SIZE - 40].encode()))
+
+
+def generate_file(path: str, args, run: int):
+    with open(path, 'wb') as fd:
+        generate(fd, args.size_mb * 1024 * 1024, run, args.change_ratio, args.seed)
+
+
+def run_scenario(name: str, run: int, func) -> dict:
+    start = time.monotonic()
+    result = func()
+    duration = time.monotonic() - start
+    result.update({
+        'scenario': name,
+        'run': run,
+        'seconds': duration,
+        'parent_max_rss_kib': common.max_rss(),
+    })
+    result['mb_per_s'] = result.get('bytes', 0) / duration / 1000 ** 2 if duration else 0.0
+    print('{scenario} run {run}: {mb_per_s:.1f} MB/s in {seconds:.1f}s'.format(**result), file=sys.stderr)
+    return result
+
+
+def benchmark(args):
+    workdir = tempfile.mkdtemp(prefix='rcb-benchmark-')
+    repository = os.path.join(workdir, 'repository')
+    common.setup_environment(repository)
+
+    from restic_compose_backup import commands, restic
+    from restic_compose_backup.config import config
+    config.cache_dir = os.path.join(workdir, 'cache')
+    config.progress_interval = 3600
+
+    has_restic = shutil.which('restic') is not None
+    results = []
+    try:
+        if has_restic:
+            commands.run(restic.restic(repository, ['init']))
+
+        for run in range(args.runs):
+            dump = os.path.join(workdir, 'dump.sql')
+            generate_file(dump, args, run)
+            dump_command = ['cat', dump]
+
+            def relay():
+                with mock.patch('restic_compose_backup.restic.restic', return_value=DISCARD_COMMAND):
+                    exit_code, summary = restic.backup_from_stdin(
+                        repository, '/databases/bench.sql', dump_command, with_summary=True)
+                return {
+                    'exit_code': exit_code,
+                    'bytes': summary['dump_bytes'],
+                    'read_wait': summary['dump_read_wait'],
+                    'write_wait': summary['dump_write_wait'],
+                }
+
+            def stream():
+                counted = [0]
+
+                def on_line(line):
+                    counted[0] += len(line)
+
+                exit_code = commands.run_stream(dump_command, on_line)
+                return {'exit_code': exit_code, 'bytes': counted[0]}
+
+            results.append(run_scenario('relay', run, relay))
+            results.append(run_scenario('stream', run, stream))
+
+            if not has_restic:
+                results.append({'scenario': 'restic', 'run': run, 'skipped': 'restic not found'})
+                continue
+
+            def backup():
+                before = common.directory_size(repository)
+                exit_code, summary = restic.backup_from_stdin(
+                    repository, '/databases/bench.sql', dump_command, with_summary=True)
+                return {
+                    'exit_code': exit_code,
+                    'bytes': summary.get('dump_bytes', 0),
+                    'read_wait': summary.get('dump_read_wait', 0),
+                    'write_wait': summary.get('dump_write_wait', 0),
+                    'data_added': summary.get('data_added', 0),
+                    'repository_growth_bytes': common.directory_size(repository) - before,
+                }
+
+            results.append(run_scenario('restic', run, backup))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    common.write_results('dump_pipeline', {
+        'size_mb': args.size_mb,
+        'runs': args.runs,
+        'change_ratio': args.change_ratio,
+        'seed': args.seed,
+        'pipe_size': config.pipe_size,
+    }, results, args.output)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('action', nargs='?', default='benchmark', choices=['benchmark', 'generate'])
+    parser.add_argument('--size-mb', type=int, default=64, help="Size of the synthetic dump")
+    parser.add_argument('--runs', type=int, default=3, help="Number of backups of the dump")
+    parser.add_argument('--run', type=int, default=0, help="Run number when generating a dump to stdout")
+    parser.add_argument('--change-ratio', type=float, default=0.05, help="Share of rows changed between runs")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help="Result file. Printed to stdout if not set")
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    arguments = parse_args()
+    if arguments.action == 'generate':
+        generate(sys.stdout.buffer, arguments.size_mb * 1024 * 1024, arguments.run,
+                 arguments.change_ratio, arguments.seed)
+    else:
+        benchmark(arguments)
@@ -0,0 +1,64 @@
+"""
+Shared helpers for the benchmarks. Results are written as json so
+runs on different commits can be compared.
+"""
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+
+def setup_environment(repository: str = '/tmp/rcb-benchmark', password: str = 'benchmark'):
+    """The config is read when the package is imported so the restic env vars must be set first"""
+    os.environ.setdefault('RESTIC_REPOSITORY', repository)
+    os.environ.setdefault('RESTIC_PASSWORD', password)
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def max_rss() -> int:
+    """int: Peak resident set size of this process in KiB"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+
+def directory_size(path: str) -> int:
+    size = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+
+    return size
+
+
+def write_results(name: str, parameters: dict, results: list, output: str = None):
+    """Write the results with enough metadata to compare runs between commits"""
+    document = {
+        'benchmark': name,
+        'commit': git_commit(),
+        'timestamp': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'parameters': parameters,
+        'results': results,
+    }
+    data = json.dumps(document, indent=2, sort_keys=True)
+    if output:
+        with open(output, 'w') as fd:
+            fd.write(data + '\n')
+    else:
+        sys.stdout.write(data + '\n')
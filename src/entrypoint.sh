@@ -6,6 +6,11 @@ rcb dump-env > /env.sh
 # Write crontab
 rcb crontab > crontab
 
+# Serve prometheus metrics if enabled
+if [ -n "$METRICS_DIR" ] && [ -n "$METRICS_PORT" ]; then
+    rcb metrics-server &
+fi
+
 # start cron in the foreground
 crontab crontab
 crond -f
@@ -1,7 +1,12 @@
+import atexit
 import logging
+import threading
+import time
+from concurrent.futures import Future, wait
 
 from restic_compose_backup.alerts.smtp import SMTPAlert
 from restic_compose_backup.alerts.discord import DiscordWebhookAlert
+from restic_compose_backup.config import config
 
 logger = logging.getLogger(__name__)
 
@@ -10,27 +15,108 @@ ALERT_ERROR = 'ERROR'
 ALERT_TYPES = [ALERT_INFO, ALERT_ERROR]
 BACKENDS = [SMTPAlert, DiscordWebhookAlert]
 
+_lock = threading.RLock()
+_backends = None
+_pending = set()
+# Monotonic time after which deliveries give up. Set by flush
+_deadline = None
+
 
 def send(subject: str = None, body: str = None, alert_type: str = 'INFO'):
-    """Send alert to all configured backends"""
-    alert_classes = configured_alert_types()
-    for instance in alert_classes:
+    """
+    Send alert to all configured backends. Alerts are sent in the
+    background so a slow backend never blocks the caller.
+    Use ``flush`` to wait for them.
+    """
+    backends = configured_alert_types()
+    if len(backends) == 0:
+        logger.info("No alerts configured")
+        return
+
+    for instance in backends:
         logger.info('Configured: %s', instance.name)
+        future = Future()
+        with _lock:
+            _pending.add(future)
+        future.add_done_callback(_done)
+        # Daemon threads so a hung backend cannot keep the process alive after flush
+        threading.Thread(
+            target=_run, args=(future, instance, f'[{alert_type}] {subject}', body),
+            name=f'alert-{instance.name}', daemon=True,
+        ).start()
+
+
+def _run(future: Future, instance, subject: str, body: str):
+    try:
+        future.set_result(deliver(instance, subject, body))
+    except Exception as ex:
+        future.set_exception(ex)
+
+
+def _done(future):
+    with _lock:
+        _pending.discard(future)
+
+
+def deliver(instance, subject: str, body: str) -> bool:
+    """
+    Send an alert to a single backend retrying with exponential backoff.
+    No attempt is started or waited for past the deadline set by ``flush``.
+    """
+    for attempt in range(1, config.alert_retries + 1):
+        timeout = config.alert_timeout
+        if _deadline is not None:
+            timeout = min(timeout, _deadline - time.monotonic())
+            if timeout <= 0:
+                logger.error("Gave up sending alert [%s] at the flush deadline", instance.name)
+                return False
+
         try:
-            instance.send(
-                subject=f'[{alert_type}] {subject}',
-                body=body,
-            )
+            instance.send(subject=subject, body=body, timeout=timeout)
+            return True
         except Exception as ex:
-            logger.error("Exception raised when sending alert [%s]: %s", instance.name, ex)
-            logger.exception(ex)
+            logger.error("Exception raised when sending alert [%s] (attempt %s/%s): %s",
+                         instance.name, attempt, config.alert_retries, ex)
+            if attempt < config.alert_retries:
+                delay = config.alert_backoff * 2 ** (attempt - 1)
+                if _deadline is not None:
+                    delay = min(delay, max(0, _deadline - time.monotonic()))
+                time.sleep(delay)
 
-    if len(alert_classes) == 0:
-        logger.info("No alerts configured")
+    return False
+
+
+def flush(timeout: float = None) -> bool:
+    """
+    Wait up to ``timeout`` seconds for pending alerts. Returns False if some were not sent in time.
+    Deliveries stop retrying at the deadline and the ones still running do not delay the exit.
+    """
+    global _deadline
+    with _lock:
+        pending = list(_pending)
+    if not pending:
+        return True
+
+    timeout = config.alert_flush_timeout if timeout is None else timeout
+    _deadline = time.monotonic() + timeout
+    try:
+        _, not_done = wait(pending, timeout=timeout)
+    finally:
+        _deadline = None
+
+    if not_done:
+        logger.error("%s alerts not sent within %s seconds", len(not_done), timeout)
+        return False
+
+    return True
 
 
 def configured_alert_types():
-    """Returns a list of configured alert class instances"""
+    """Returns a list of configured alert class instances. Backends are created once"""
+    global _backends
+    if _backends is not None:
+        return _backends
+
     logger.debug('Getting alert backends')
     entires = []
 
@@ -40,4 +126,8 @@ def configured_alert_types():
         if instance:
             entires.append(instance)
 
-    return entires
+    _backends = entires
+    return _backends
+
+
+atexit.register(flush)
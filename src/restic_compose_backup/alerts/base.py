@@ -10,5 +10,6 @@ class BaseAlert:
     def properly_configured(self) -> bool:
         return False
 
-    def send(self, subject: str = None, body: str = None, alert_type: str = None):
+    def send(self, subject: str = None, body: str = None, timeout: float = None):
+        """Send the alert raising an exception on failure"""
         pass
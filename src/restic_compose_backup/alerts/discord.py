@@ -27,7 +27,7 @@ class DiscordWebhookAlert(BaseAlert):
     def properly_configured(self) -> bool:
         return isinstance(self.url, str) and self.url.startswith("https://")
 
-    def send(self, subject: str = None, body: str = None, alert_type: str = None):
+    def send(self, subject: str = None, body: str = None, timeout: float = None):
         """Send basic webhook request. Max embed size is 6000"""
         logger.info("Triggering discord webhook")
         # NOTE: The title size is 2048
@@ -41,8 +41,8 @@ class DiscordWebhookAlert(BaseAlert):
                 },
             ]
         }
-        response = requests.post(self.url, params={'wait': True}, json=data)
+        response = requests.post(self.url, params={'wait': True}, json=data, timeout=timeout)
         if response.status_code not in self.success_codes:
-            logger.error("Discord webhook failed: %s: %s", response.status_code, response.content)
-        else:
-            logger.info('Discord webhook successful')
+            raise RuntimeError("Discord webhook failed: {}: {}".format(response.status_code, response.content))
+
+        logger.info('Discord webhook successful')
@@ -36,21 +36,17 @@ class SMTPAlert(BaseAlert):
     def properly_configured(self) -> bool:
         return self.host and self.port and self.user and len(self.to) > 0
 
-    def send(self, subject: str = None, body: str = None, alert_type: str = 'INFO'):
-        # send_mail("Hello world!")
+    def send(self, subject: str = None, body: str = None, timeout: float = None):
         msg = MIMEText(body)
-        msg['Subject'] = f"[{alert_type}] {subject}"
+        msg['Subject'] = subject
         msg['From'] = self.user
         msg['To'] = ', '.join(self.to)
 
-        try:
-            logger.info("Connecting to %s port %s", self.host, self.port)
-            server = smtplib.SMTP_SSL(self.host, self.port)
+        # Alerts are rare so a connection is opened per alert
+        # instead of keeping one the server would drop anyway
+        logger.info("Connecting to %s port %s", self.host, self.port)
+        with smtplib.SMTP_SSL(self.host, self.port, timeout=timeout) as server:
             server.ehlo()
             server.login(self.user, self.password)
             server.sendmail(self.user, self.to, msg.as_string())
-            logger.info('Email sent')
-        except Exception as ex:
-            logger.exception(ex)
-        finally:
-            server.close()
+        logger.info('Email sent')
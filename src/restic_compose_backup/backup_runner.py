@@ -1,58 +1,112 @@
+import codecs
+import gzip
 import logging
 import os
+from collections import deque
+from typing import Iterable, Iterator, List, Tuple
 
-from restic_compose_backup import utils
+from restic_compose_backup import metrics, utils
+from restic_compose_backup.config import config
 
 logger = logging.getLogger(__name__)
 
 
+class LineSplitter:
+    """
+    Incrementally decodes utf-8 chunks into lines. Multi-byte characters split
+    across chunks are decoded correctly and lines are cut at ``max_length``
+    so a child never writing a newline cannot grow the buffer.
+    """
+    def __init__(self, max_length: int = 65536):
+        self.max_length = max_length
+        self._decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self._pending = ''
+
+    def feed(self, data) -> List[str]:
+        """Add a chunk returning the completed lines"""
+        # docker ce 17 and 18 return strings instead of bytes
+        if isinstance(data, bytes):
+            data = self._decoder.decode(data)
+
+        self._pending += data
+        lines = self._pending.split('\n')
+        self._pending = lines.pop()
+        while len(self._pending) >= self.max_length:
+            lines.append(self._pending[:self.max_length])
+            self._pending = self._pending[self.max_length:]
+
+        return [line.rstrip() for line in lines]
+
+    def close(self) -> List[str]:
+        """Flush the last unterminated line"""
+        self._pending += self._decoder.decode(b'', final=True)
+        line, self._pending = self._pending.rstrip(), ''
+        return [line] if line else []
+
+
+def readlines(stream: Iterable, max_length: int = 65536) -> Iterator[str]:
+    """Read a stream of chunks line by line"""
+    splitter = LineSplitter(max_length)
+    for data in stream:
+        yield from splitter.feed(data)
+
+    yield from splitter.close()
+
+
+def open_log(path: str, keep: int = 1, compress: bool = False):
+    """
+    Open the log file for the backup process rotating
+    previous logs so at most ``keep`` files exist.
+    """
+    suffix = '.gz' if compress else ''
+    paths = [f'{path}{suffix}'] + [f'{path}.{i}{suffix}' for i in range(1, max(1, keep))]
+    for src, dst in reversed(list(zip(paths, paths[1:]))):
+        if os.path.exists(src):
+            os.replace(src, dst)
+
+    if compress:
+        return gzip.open(paths[0], 'wt', encoding='utf-8')
+
+    return open(paths[0], 'w', encoding='utf-8')
+
+
 def run(image: str = None, command: str = None, volumes: dict = None,
-        environment: dict = None, labels: dict = None, source_container_id: str = None):
+        environment: dict = None, labels: dict = None, source_container_id: str = None) -> Tuple[int, List[str]]:
+    """
+    Run the backup process container relaying its output.
+
+    Returns:
+        Tuple with the exit code and the last ``BACKUP_LOG_TAIL`` lines of output
+    """
     logger.info("Starting backup container")
     client = utils.docker_client()
 
-    container = client.containers.run(
-        image,
-        command,
-        labels=labels,
-        # auto_remove=True,  # We remove the container further down
-        detach=True,
-        environment=environment + ['BACKUP_PROCESS_CONTAINER=true'],
-        volumes=volumes,
-        network_mode=f'container:{source_container_id}',  # Reuse original container's network stack.
-        working_dir=os.getcwd(),
-        tty=True,
-    )
+    # Only creating and starting the container. Its run time is the backup_process phase
+    with metrics.phase('container_start'):
+        container = client.containers.run(
+            image,
+            command,
+            labels=labels,
+            # auto_remove=True,  # We remove the container further down
+            detach=True,
+            environment=environment + ['BACKUP_PROCESS_CONTAINER=true'],
+            volumes=volumes,
+            network_mode=f'container:{source_container_id}',  # Reuse original container's network stack.
+            working_dir=os.getcwd(),
+            tty=True,
+        )
 
     logger.info("Backup process container: %s", container.name)
     log_generator = container.logs(stdout=True, stderr=True, stream=True, follow=True)
 
-    def readlines(stream):
-        """Read stream line by line"""
-        while True:
-            line = ""
-            while True:
-                try:
-                    # Make log streaming work for docker ce 17 and 18.
-                    # For some reason strings are returned instead if bytes.
-                    data = next(stream)
-                    if isinstance(data, bytes):
-                        line += data.decode()
-                    elif isinstance(data, str):
-                        line += data
-                    if line.endswith('\n'):
-                        break
-                except StopIteration:
-                    break
-            if line:
-                yield line.rstrip()
-            else:
-                break
-
-    with open('backup.log', 'w') as fd:
+    # Only the tail is kept in memory for alerts
+    tail = deque(maxlen=config.backup_log_tail)
+    with open_log(config.backup_log, keep=config.backup_log_keep,
+                  compress=utils.is_true(config.backup_log_compress)) as fd:
         for line in readlines(log_generator):
             fd.write(line)
             fd.write('\n')
+            tail.append(line)
             logger.info(line)
 
     container.wait()
@@ -60,4 +114,4 @@ def run(image: str = None, command: str = None, volumes: dict = None,
     logger.debug("Container ExitCode %s", container.attrs['State']['ExitCode'])
     container.remove()
 
-    return container.attrs['State']['ExitCode']
+    return container.attrs['State']['ExitCode'], list(tail)
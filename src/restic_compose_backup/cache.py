@@ -0,0 +1,68 @@
+"""
+Restic cache usage reporting.
+
+Restic does not report cache hits so we compare the files in the
+cache directory before and after a run. Files that were already
+present are counted as hits and new files as downloads.
+"""
+import logging
+import os
+from typing import Dict
+
+from restic_compose_backup import metrics, utils
+
+logger = logging.getLogger(__name__)
+
+
+def scan(path: str) -> Dict[str, int]:
+    """Map every file in the cache directory to its size"""
+    files = {}
+    stack = [path]
+    while stack:
+        try:
+            entries = os.scandir(stack.pop())
+        except OSError:
+            continue
+
+        with entries:
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        stack.append(entry.path)
+                    elif entry.is_file(follow_symlinks=False):
+                        files[entry.path] = entry.stat(follow_symlinks=False).st_size
+                except OSError:
+                    continue
+
+    return files
+
+
+def report(before: Dict[str, int], after: Dict[str, int]) -> dict:
+    """Compare two scans of the cache directory"""
+    downloaded = {path: size for path, size in after.items() if path not in before}
+    return {
+        'size': sum(after.values()),
+        'files': len(after),
+        'downloaded_files': len(downloaded),
+        'downloaded_bytes': sum(downloaded.values()),
+        'hit_ratio': (len(after) - len(downloaded)) / len(after) if after else 0.0,
+    }
+
+
+def log_size(files: Dict[str, int]):
+    size = sum(files.values())
+    logger.info('Cache: %s in %s files', utils.format_bytes(size), len(files))
+    metrics.registry.set('cache_size_bytes', size)
+
+
+def log_report(values: dict):
+    logger.info(
+        'Cache: %s in %s files, downloaded %s in %s files, estimated hit ratio %.1f%%',
+        utils.format_bytes(values['size']),
+        values['files'],
+        utils.format_bytes(values['downloaded_bytes']),
+        values['downloaded_files'],
+        values['hit_ratio'] * 100,
+    )
+    metrics.registry.set('cache_size_bytes', values['size'])
+    metrics.registry.set('cache_hit_ratio', values['hit_ratio'])
@@ -1,12 +1,23 @@
 import argparse
 import os
 import logging
+import time
+from typing import List
 
 from restic_compose_backup import (
     alerts,
     backup_runner,
+    cache,
+    enums,
+    fingerprint,
+    jobs,
+    lock,
     log,
+    metrics,
+    plan,
     restic,
+    state,
+    swarm,
 )
 from restic_compose_backup.config import Config
 from restic_compose_backup.containers import RunningContainers
@@ -20,11 +31,26 @@ def main():
     args = parse_args()
     config = Config()
     log.setup(level=args.log_level or config.log_level)
-    containers = RunningContainers()
 
-    # Ensure log level is propagated to parent container if overridden
-    if args.log_level:
-        containers.this_container.set_config_env('LOG_LEVEL', args.log_level)
+    # The backup process container executes a plan and skips discovery
+    backup_plan = plan.BackupPlan.from_env()
+    if args.action == 'start-backup-process' and backup_plan:
+        containers = None
+        metrics.registry.configure(project=backup_plan.project_name, role='process')
+    elif args.action == 'metrics-server':
+        containers = None
+    else:
+        with metrics.phase('discovery'):
+            containers = RunningContainers()
+        if args.action in ['backup', 'cleanup', 'maintenance', 'swarm-backup']:
+            # Maintenance tasks run from separate cron entries and get separate textfiles
+            tasks = [task for task in ['prune', 'check', 'cleanup_cache'] if getattr(args, task)]
+            role = '_'.join([args.action] + tasks) if args.action == 'maintenance' else args.action.replace('-', '_')
+            metrics.registry.configure(project=containers.project_name, role=role)
+
+        # Ensure log level is propagated to parent container if overridden
+        if args.log_level:
+            containers.this_container.set_config_env('LOG_LEVEL', args.log_level)
 
     if args.action == 'status':
         status(config, containers)
@@ -33,17 +59,27 @@ def main():
         snapshots(config, containers)
 
     elif args.action == 'backup':
-        backup(config, containers)
+        backup(config, containers, forget=not args.no_forget)
 
     elif args.action == 'start-backup-process':
-        start_backup_process(config, containers)
+        start_backup_process(config, containers, backup_plan)
+
+    elif args.action == 'swarm-backup':
+        swarm_backup(config, containers)
 
     elif args.action == 'cleanup':
         cleanup(config, containers)
 
+    elif args.action == 'maintenance':
+        maintenance(config, containers, prune=args.prune, check=args.check,
+                    cleanup_cache=args.cleanup_cache, force=args.force)
+
     elif args.action == 'alert':
         alert(config, containers)
 
+    elif args.action == 'restore-postgres':
+        restore_postgres(config, containers, args.service, args.snapshot)
+
     elif args.action == 'version':
         import restic_compose_backup
         print(restic_compose_backup.__version__)
@@ -54,6 +90,9 @@ def main():
     elif args.action == "dump-env":
         dump_env()
 
+    elif args.action == "metrics-server":
+        metrics_server(config)
+
     # Random test stuff here
     elif args.action == "test":
         nodes = utils.get_swarm_nodes()
@@ -73,19 +112,12 @@ def status(config, containers):
     logger.debug("Exclude bind mounts from backups?: %s", utils.is_true(config.exclude_bind_mounts))
     logger.info("Checking docker availability")
 
-    utils.list_containers()
+    utils.ping()
 
     if containers.stale_backup_process_containers:
         utils.remove_containers(containers.stale_backup_process_containers)
 
-    # Check if repository is initialized with restic snapshots
-    if not restic.is_initialized(config.repository):
-        logger.info("Could not get repository info. Attempting to initialize it.")
-        result = restic.init_repo(config.repository)
-        if result == 0:
-            logger.info("Successfully initialized repository: %s", config.repository)
-        else:
-            logger.error("Failed to initialize repository")
+    init_repository(config)
 
     logger.info("%s Detected Config %s", "-" * 25, "-" * 25)
 
@@ -121,8 +153,19 @@ def status(config, containers):
     logger.info("-" * 67)
 
 
-def backup(config, containers):
-    """Request a backup to start"""
+def init_repository(config):
+    """Initialize the repository if restic snapshots cannot read it"""
+    if not restic.is_initialized(config.repository):
+        logger.info("Could not get repository info. Attempting to initialize it.")
+        result = restic.init_repo(config.repository)
+        if result == 0:
+            logger.info("Successfully initialized repository: %s", config.repository)
+        else:
+            logger.error("Failed to initialize repository")
+
+
+def backup(config, containers, forget: bool = True):
+    """Request a backup to start. Outdated snapshots are forgotten unless ``forget`` is false"""
     # Make sure we don't spawn multiple backup processes
     if containers.backup_process_running:
         alerts.send(
@@ -136,26 +179,48 @@ def backup(config, containers):
         )
         raise RuntimeError("Backup process already running")
 
+    if containers.stale_backup_process_containers:
+        utils.remove_containers(containers.stale_backup_process_containers)
+
+    # Everything the backup process needs is decided here and passed on
+    backup_plan = plan.BackupPlan.build(containers, config)
+    if backup_plan.is_empty:
+        logger.info("No volumes or databases configured for backup. Not starting backup process container")
+        return
+
+    backup_plan.log_summary()
+    init_repository(config)
+
     # Map all volumes from the backup container into the backup process container
     volumes = containers.this_container.volumes
 
     # Map volumes from other containers we are backing up
-    mounts = containers.generate_backup_mounts('/volumes')
-    volumes.update(mounts)
+    volumes.update(backup_plan.mounts)
+
+    # Keep the restic cache warm between runs
+    volumes.update(cache_volume(config, containers))
+
+    # Every process container has a new hostname. Use a stable host so restic finds the parent snapshots
+    environment = containers.this_container.environment + [backup_plan.to_env()]
+    if not config.restic_host:
+        environment.append(f'RESTIC_HOST={containers.stable_name}')
 
     logger.debug('Starting backup container with image %s', containers.this_container.image)
     try:
-        result = backup_runner.run(
-            image=containers.this_container.image,
-            command='restic-compose-backup start-backup-process',
-            volumes=volumes,
-            environment=containers.this_container.environment,
-            source_container_id=containers.this_container.id,
-            labels={
-                containers.backup_process_label: 'True',
-                "com.docker.compose.project": containers.project_name,
-            },
-        )
+        # Backups of projects sharing the repository run concurrently but not during prune or check
+        with lock.repository_lock(config.repository, 'backup'), metrics.phase('backup_process') as phase:
+            result, output = backup_runner.run(
+                image=containers.this_container.image,
+                command='restic-compose-backup start-backup-process',
+                volumes=volumes,
+                environment=environment,
+                source_container_id=containers.this_container.id,
+                labels={
+                    containers.backup_process_label: 'True',
+                    "com.docker.compose.project": containers.project_name,
+                },
+            )
+            phase.exit_code = result
     except Exception as ex:
         logger.exception(ex)
         alerts.send(
@@ -171,12 +236,97 @@ def backup(config, containers):
     if result != 0:
         alerts.send(
             subject="Backup process exited with non-zero code",
-            body=open('backup.log').read(),
+            body="\n".join(output),
+            alert_type='ERROR',
+        )
+        return
+
+    if not forget:
+        return
+
+    # Prune and check are scheduled separately with the maintenance command
+    result = forget_snapshots(config, backup_plan)
+    if result != 0:
+        alerts.send(
+            subject="Forget exited with non-zero code",
+            body=f"restic forget exit code: {result}",
+            alert_type='ERROR',
+        )
+
+
+def swarm_backup(config, containers):
+    """Back up every node in the swarm by running the backup command in an agent pinned to each node"""
+    if not utils.get_swarm_nodes():
+        logger.error("The swarm-backup command must run on a swarm manager node")
+        exit(1)
+
+    # Make sure we don't run agents for two swarm backups at the same time
+    agents = swarm.list_agents()
+    running = [agent.name for agent in agents if swarm.agent_running(agent)]
+    if running:
+        alerts.send(
+            subject="Swarm backup already running",
+            body="Backup agents are already running: {}".format(', '.join(running)),
+            alert_type='ERROR',
+        )
+        raise RuntimeError("Swarm backup already running")
+
+    for agent in agents:
+        logger.info('Removing stale backup agent %s', agent.name)
+        agent.remove()
+
+    nodes = swarm.find_nodes()
+    if not nodes:
+        logger.info("No services in the swarm have 'restic-compose-backup.*' labels")
+        return
+
+    for node in nodes:
+        logger.info('node %s: %s', node.hostname, ', '.join(sorted(node.services)))
+
+    init_repository(config)
+
+    node_jobs = [
+        jobs.Job(
+            name=f'node {node.hostname}',
+            func=lambda node=node: swarm.run_agent(
+                node,
+                image=containers.this_container.image,
+                environment=containers.this_container.environment,
+                mounts=containers.this_container.mounts,
+            ),
+        )
+        for node in nodes
+    ]
+    results = jobs.run(node_jobs, config.swarm_concurrency)
+    for node, result in zip(nodes, results):
+        metrics.record_job('swarm_agent', result, node=node.hostname)
+
+    logger.info("%s Summary %s", "-" * 25, "-" * 25)
+    for result in results:
+        log_func = logger.info if result.ok else logger.error
+        log_func('%s: exit code %s in %s', result.name, result.exit_code, utils.format_duration(result.duration))
+    logger.info("-" * 59)
+
+    # Forget takes an exclusive lock in the repository and runs once every agent has finished
+    hosts = sorted({config.restic_host or node.hostname for node, result in zip(nodes, results) if result.ok})
+    forget_result = forget_hosts(config, hosts) if hosts else 0
+
+    failed = [result for result in results if not result.ok]
+    if failed or forget_result != 0:
+        body = [f"{result.name}: exit code {result.exit_code}" for result in failed]
+        if forget_result != 0:
+            body.append(f"restic forget exit code: {forget_result}")
+        alerts.send(
+            subject="Swarm backup failed on {} of {} nodes".format(len(failed), len(results)),
+            body="\n".join(body),
             alert_type='ERROR',
         )
+        exit(1)
 
+    logger.info('Swarm backup completed')
 
-def start_backup_process(config, containers):
+
+def start_backup_process(config, containers, backup_plan=None):
     """The actual backup process running inside the spawned container"""
     if not utils.is_true(os.environ.get('BACKUP_PROCESS_CONTAINER')):
         logger.error(
@@ -192,90 +342,376 @@ def start_backup_process(config, containers):
         )
         exit(1)
 
-    status(config, containers)
-    errors = False
+    # Without a plan from the backup command we need to discover everything here
+    if backup_plan is None:
+        status(config, containers)
+        backup_plan = plan.BackupPlan.build(containers, config)
+
+    backup_plan.log_summary()
 
     # Did we actually get any volumes mounted?
-    try:
-        has_volumes = os.stat('/volumes') is not None
-    except FileNotFoundError:
+    volume_units = [unit for unit in backup_plan.volumes if os.path.exists(unit['path'])]
+    if backup_plan.volumes and not volume_units:
         logger.warning("Found no volumes to back up")
-        has_volumes = False
 
     # Warn if there is nothing to do
-    if len(containers.containers_for_backup()) == 0 and not has_volumes:
+    if not backup_plan.databases and not volume_units:
         logger.error("No containers for backup found")
         exit(1)
 
-    if has_volumes:
-        try:
-            logger.info('Backing up volumes')
-            vol_result = restic.backup_files(config.repository, source='/volumes')
-            logger.debug('Volume backup exit code: %s', vol_result)
-            if vol_result != 0:
-                logger.error('Volume backup exited with non-zero code: %s', vol_result)
-                errors = True
-        except Exception as ex:
-            logger.error('Exception raised during volume backup')
-            logger.exception(ex)
-            errors = True
+    cache_before = cache.scan(config.cache_dir)
+
+    fingerprints = None
+    if utils.is_true(config.volume_fingerprints) and volume_units:
+        volume_units, fingerprints = skip_unchanged_volumes(config, volume_units)
+
+    results = []
+    if volume_units:
+        logger.info('Backing up volumes')
+        volume_jobs = [
+            jobs.Job(name=f"volumes in {unit['path']}", func=lambda unit=unit: backup_volumes(config, unit))
+            for unit in volume_units
+        ]
+        volume_results = jobs.run(volume_jobs, config.volume_backup_concurrency)
+        for unit, result in zip(volume_units, volume_results):
+            metrics.record_job('volume_backup', result, unit=unit['path'])
+        results += volume_results
+
+        # Remember the fingerprints of units with a new snapshot
+        if fingerprints is not None:
+            for unit, result in zip(volume_units, volume_results):
+                if result.ok and unit.get('fingerprint'):
+                    fingerprints[unit['path']] = unit['fingerprint']
+            fingerprints.save()
 
     # back up databases
     logger.info('Backing up databases')
-    for container in containers.containers_for_backup():
-        if container.database_backup_enabled:
-            try:
-                instance = container.instance
-                logger.info('Backing up %s in service %s', instance.container_type, instance.service_name)
-                result = instance.backup()
-                logger.debug('Exit code: %s', result)
-                if result != 0:
-                    logger.error('Backup command exited with non-zero code: %s', result)
-                    errors = True
-            except Exception as ex:
-                logger.exception(ex)
-                errors = True
+    database_jobs = []
+    for unit in backup_plan.databases:
+        database_jobs.append(jobs.Job(
+            name=f"{unit['type']} in service {unit['service']}",
+            func=lambda unit=unit: backup_database(backup_plan, unit),
+            weight=unit['concurrency'],
+        ))
+    database_results = jobs.run(database_jobs, config.database_backup_concurrency)
+    for unit, result in zip(backup_plan.databases, database_results):
+        metrics.record_job('database_backup', result, service=unit['service'], unit=unit['destination'])
+    results += database_results
+
+    log_results(results)
+    cache.log_report(cache.report(cache_before, cache.scan(config.cache_dir)))
+    errors = any(not result.ok for result in results)
 
     if errors:
         logger.error('Exit code: %s', errors)
         exit(1)
 
-    # Only run cleanup if backup was successful
-    result = cleanup(config, container)
-    logger.debug('cleanup exit code: %s', result)
-    if result != 0:
-        logger.error('cleanup exit code: %s', result)
-        exit(1)
+    logger.info('Backup completed')
 
-    # Test the repository for errors
-    logger.info("Checking the repository for errors")
-    result = restic.check(config.repository)
-    if result != 0:
-        logger.error('Check exit code: %s', result)
-        exit(1)
 
-    logger.info('Backup completed')
+def log_results(results):
+    """Log exit code and restic summary for every backup unit"""
+    logger.info("%s Summary %s", "-" * 25, "-" * 25)
+    for result in results:
+        log_func = logger.info if result.ok else logger.error
+        log_func('%s: exit code %s in %s, %s', result.name, result.exit_code,
+                 utils.format_duration(result.duration), restic.format_summary(result.summary))
+    logger.info("-" * 59)
+
+
+def skip_unchanged_volumes(config, units: List[dict]):
+    """
+    Fingerprint the volume units comparing them to the fingerprints of their last snapshot.
+    The index is kept next to the restic cache so it survives the backup process container.
+
+    Returns:
+        Tuple with the changed units and the fingerprint index
+    """
+    fingerprints = state.State('fingerprints', directory=config.cache_dir)
+    changed, skipped_size = [], 0
+    for unit in units:
+        current = fingerprint.scan(unit['path'], workers=config.fingerprint_workers)
+        if current is not None and fingerprints.get(unit['path']) == current:
+            logger.info('Skipping unchanged volumes in %s (%s files, %s)',
+                        unit['path'], current['files'], utils.format_bytes(current['size']))
+            skipped_size += current['size']
+            continue
+
+        changed.append({**unit, 'fingerprint': current})
+
+    skipped = len(units) - len(changed)
+    logger.info('Skipped %s of %s volume units (%s) unchanged since their last snapshot',
+                skipped, len(units), utils.format_bytes(skipped_size))
+    metrics.registry.set('volumes_skipped', skipped)
+    metrics.registry.set('volumes_skipped_bytes', skipped_size)
+    return changed, fingerprints
+
+
+def backup_volumes(config, unit: dict):
+    """Back up a volume unit in a separate restic session"""
+    logger.info('Backing up %s', unit['path'])
+    return restic.backup_files(config.repository, source=unit['path'], with_summary=True, tags=unit['tags'])
+
+
+def backup_database(backup_plan, unit: dict) -> int:
+    """
+    Dump a single database container into restic. The container is inspected
+    here so a container gone since planning only fails its own unit.
+    """
+    try:
+        instance = backup_plan.database_container(unit)
+    except RuntimeError as ex:
+        logger.error(ex)
+        return 1
+
+    logger.info('Backing up %s in service %s', instance.container_type, instance.service_name)
+    return instance.backup()
 
 
 def cleanup(config, containers):
     """Run forget / prune to minimize storage space"""
+    forget_result = forget_snapshots(config, plan.BackupPlan.build(containers, config))
+    prune_result = prune_repository(config, force=True)
+    return forget_result or prune_result
+
+
+def maintenance(config, containers, prune: bool = False, check: bool = False,
+                cleanup_cache: bool = False, force: bool = False):
+    """Scheduled repository maintenance. Runs both prune and check if no task is selected"""
+    if not prune and not check and not cleanup_cache:
+        prune = check = True
+
+    if not containers.this_container.get_mount(config.cache_dir):
+        logger.warning("No volume mounted at %s. The restic cache is lost when the container is removed",
+                       config.cache_dir)
+
+    results = {}
+    if prune:
+        results['prune'] = prune_repository(config, force=force)
+
+    if check:
+        results['check'] = check_repository(config)
+
+    if cleanup_cache:
+        logger.info("Removing old cache directories")
+        with metrics.phase('cache_cleanup') as phase:
+            results['cache cleanup'] = phase.exit_code = restic.cache_cleanup(config.repository)
+        cache.log_size(cache.scan(config.cache_dir))
+
+    failed = {task: result for task, result in results.items() if result != 0}
+    if failed:
+        for task, result in failed.items():
+            logger.error('%s exit code: %s', task, result)
+        alerts.send(
+            subject="{}: Repository maintenance failed".format(containers.project_name),
+            body="\n".join(f"restic {task} exit code: {result}" for task, result in failed.items()),
+            alert_type='ERROR',
+        )
+        exit(1)
+
+    logger.info('Maintenance completed')
+
+
+def cache_volume(config, containers) -> dict:
+    """
+    The restic cache is reused from the backup service if it has a mount
+    for it. Otherwise a named volume is mounted in the backup process container.
+    """
+    if containers.this_container.get_mount(config.cache_dir):
+        return {}
+
+    # Swarm services have no compose project and docker rejects volume names starting with _
+    name = config.cache_volume or f'{containers.stable_name}_restic_cache'
+    logger.info("No volume mounted at %s. Using volume '%s' for the restic cache", config.cache_dir, name)
+    return {name: {'bind': config.cache_dir, 'mode': 'rw'}}
+
+
+def check_repository(config) -> int:
+    """Check the repository reading the next data subset if rolling verification is enabled"""
+    try:
+        with lock.repository_lock(config.repository, 'check', exclusive=True):
+            return check_data(config)
+    except TimeoutError as ex:
+        logger.error(ex)
+        return 1
+
+
+def check_data(config) -> int:
+    """Run the check holding the repository lock"""
+    subsets = config.check_read_data_subsets
+    if subsets <= 0:
+        logger.info("Checking the repository for errors")
+        with metrics.phase('check') as phase:
+            phase.exit_code = restic.check(config.repository)
+        return phase.exit_code
+
+    maintenance_state = state.State('maintenance')
+    subset = maintenance_state.get('check_subset', 1)
+    if not 1 <= subset <= subsets:
+        subset = 1
+
+    # restic stats walks every snapshot. The size is only read at the start of each pass
+    if subset == 1 or 'repository_size' not in maintenance_state:
+        stats = restic.stats(config.repository) or {}
+        maintenance_state['repository_size'] = stats.get('total_size', 0)
+
+    # The pack data is split evenly between the subsets
+    estimate = maintenance_state['repository_size'] // subsets
+    metrics.registry.set('check_estimated_bytes', estimate, subset=f'{subset}/{subsets}')
+
+    logger.info("Checking the repository for errors reading data subset %s/%s (estimated %s)",
+                subset, subsets, utils.format_bytes(estimate))
+    with metrics.phase('check', subset=f'{subset}/{subsets}') as phase:
+        phase.exit_code = restic.check(config.repository, read_data_subset=f'{subset}/{subsets}')
+
+    logger.info("Read data subset %s/%s (estimated %s) in %s", subset, subsets,
+                utils.format_bytes(estimate), utils.format_duration(phase.duration))
+
+    # A failed subset is checked again in the next run
+    if phase.exit_code == 0:
+        maintenance_state['check_subset'] = subset % subsets + 1
+    maintenance_state.save()
+
+    return phase.exit_code
+
+
+def forget_snapshots(config, backup_plan) -> int:
+    """
+    Forget outdated snapshots of each unit in the backup plan separately
+    and then of every path backed up in the project so snapshots of
+    removed or renamed units still expire.
+    """
+    groups = {}
+    for unit in backup_plan.units:
+        # Volume units of the same service share their filter
+        groups.setdefault(restic.unit_filter(unit['tags']), {'tags': unit['tags']})
+
+    # The image tag changes with every upgrade so the project is grouped by host and paths only
+    project = [f'{enums.TAG_PROJECT}={backup_plan.project_name}']
+    groups.setdefault(restic.unit_filter(project), {'tags': project})
+    return forget_groups(config, list(groups.values()))
+
+
+def forget_hosts(config, hosts: List[str]) -> int:
+    """Forget outdated snapshots of every path backed up by each host"""
+    return forget_groups(config, [{'host': host} for host in hosts])
+
+
+def forget_groups(config, groups: List[dict]) -> int:
+    """
+    Forget outdated snapshots counting them towards the next prune.
+    Each group selects snapshots by ``tags`` or ``host`` (see ``restic.forget``).
+    Snapshots without tags made before backup units were tagged are always included
+    so they still expire.
+    """
     logger.info('Forget outdated snapshots')
-    forget_result = restic.forget(
-        config.repository,
-        config.keep_daily,
-        config.keep_weekly,
-        config.keep_monthly,
-        config.keep_yearly,
-    )
-    logger.info('Prune stale data freeing storage space')
-    prune_result = restic.prune(config.repository)
-    return forget_result and prune_result
+    result, removed = 0, 0
+    try:
+        with lock.repository_lock(config.repository, 'forget', exclusive=True):
+            for group in groups + [{'untagged': True}]:
+                if group.get('tags'):
+                    name = restic.unit_filter(group['tags'])
+                elif group.get('host'):
+                    name = f"host={group['host']}"
+                else:
+                    name = 'untagged'
+                with metrics.phase('forget', unit=name) as phase:
+                    phase.exit_code, group_removed = restic.forget(
+                        config.repository,
+                        config.keep_daily,
+                        config.keep_weekly,
+                        config.keep_monthly,
+                        config.keep_yearly,
+                        **group,
+                    )
+
+                removed += group_removed
+                if phase.exit_code != 0:
+                    logger.error('Forget exit code for %s: %s', name, phase.exit_code)
+                    result = phase.exit_code
+
+            # Updated under the lock so a concurrent prune does not overwrite the count
+            if removed:
+                maintenance_state = state.State('maintenance')
+                count = maintenance_state.get('forgotten_since_prune', 0) + removed
+                maintenance_state['forgotten_since_prune'] = count
+                maintenance_state.save()
+    except TimeoutError as ex:
+        logger.error(ex)
+        result = 1
+
+    return result
+
+
+def prune_repository(config, force: bool = False) -> int:
+    """Prune stale data if enough time has passed or enough snapshots were forgotten"""
+    try:
+        with lock.repository_lock(config.repository, 'prune', exclusive=True):
+            # The state is read and written under the lock so concurrent runs do not overwrite it
+            maintenance_state = state.State('maintenance')
+            if not force and not prune_due(config, maintenance_state):
+                return 0
+
+            logger.info('Prune stale data freeing storage space')
+            with metrics.phase('prune') as phase:
+                result = phase.exit_code = restic.prune(config.repository)
+
+            if result == 0:
+                maintenance_state['last_prune'] = time.time()
+                maintenance_state['forgotten_since_prune'] = 0
+                maintenance_state.save()
+    except TimeoutError as ex:
+        logger.error(ex)
+        return 1
+
+    return result
+
+
+def prune_due(config, maintenance_state: dict) -> bool:
+    """Is a prune due according to PRUNE_MIN_HOURS and PRUNE_MIN_FORGOTTEN?"""
+    last_prune = maintenance_state.get('last_prune')
+    if last_prune is None:
+        logger.info('No previous prune recorded')
+        return True
+
+    hours = (time.time() - last_prune) / 3600
+    forgotten = maintenance_state.get('forgotten_since_prune', 0)
+    if hours >= config.prune_min_hours:
+        logger.info('%.1f hours since last prune', hours)
+        return True
+
+    if config.prune_min_forgotten and forgotten >= config.prune_min_forgotten:
+        logger.info('%s snapshots forgotten since last prune', forgotten)
+        return True
+
+    logger.info('Skipping prune: %.1f hours and %s forgotten snapshots since last prune', hours, forgotten)
+    return False
+
+
+def restore_postgres(config, containers, service: str, snapshot: str):
+    """Restore a directory format postgres dump into its service"""
+    container = containers.get_service(service) if service else None
+    if container is None or not container.postgresql_backup_enabled:
+        logger.error("No postgres service named '%s' configured for backup", service)
+        exit(1)
+
+    instance = container.instance
+    if not instance.directory_format:
+        logger.error("Service '%s' is not using directory format dumps", service)
+        exit(1)
+
+    result = instance.restore_directory(config, snapshot=snapshot)
+    if result != 0:
+        logger.error('Restore exit code: %s', result)
+        exit(1)
+
+    logger.info('Restore completed')
 
 
 def snapshots(config, containers):
     """Display restic snapshots"""
     stdout, stderr = restic.snapshots(config.repository, last=True)
-    for line in stdout.decode().split('\n'):
+    for line in stdout.split('\n'):
         print(line)
 
 
@@ -288,6 +724,15 @@ def alert(config, containers):
     )
 
 
+def metrics_server(config):
+    """Serve the metrics textfiles over http"""
+    if not config.metrics_dir or not config.metrics_port:
+        logger.error("METRICS_DIR and METRICS_PORT must be set to serve metrics")
+        exit(1)
+
+    metrics.serve(config.metrics_port, config.metrics_dir)
+
+
 def crontab(config):
     """Generate the crontab"""
     print(cron.generate_crontab(config))
@@ -310,11 +755,15 @@ def parse_args():
             'snapshots',
             'backup',
             'start-backup-process',
+            'swarm-backup',
             'alert',
             'cleanup',
+            'maintenance',
+            'restore-postgres',
             'version',
             'crontab',
             'dump-env',
+            'metrics-server',
             'test',
         ],
     )
@@ -324,6 +773,41 @@ def parse_args():
         choices=list(log.LOG_LEVELS.keys()),
         help="Log level"
     )
+    parser.add_argument(
+        '--prune',
+        action='store_true',
+        help="Prune the repository if due (maintenance)",
+    )
+    parser.add_argument(
+        '--check',
+        action='store_true',
+        help="Check the repository for errors (maintenance)",
+    )
+    parser.add_argument(
+        '--cleanup-cache',
+        action='store_true',
+        help="Remove old restic cache directories (maintenance)",
+    )
+    parser.add_argument(
+        '--no-forget',
+        action='store_true',
+        help="Do not forget outdated snapshots after the backup (backup)",
+    )
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help="Prune even if not due (maintenance)",
+    )
+    parser.add_argument(
+        '--service',
+        default=None,
+        help="Service to restore",
+    )
+    parser.add_argument(
+        '--snapshot',
+        default='latest',
+        help="Snapshot to restore from",
+    )
     return parser.parse_args()
 
 
@@ -1,9 +1,24 @@
+import fcntl
 import logging
-from typing import List, Tuple
+import os
+import sys
+import threading
+import time
+from collections import deque
+from typing import Callable, List, Tuple
 from subprocess import Popen, PIPE
 
+from restic_compose_backup import log, utils
+
 logger = logging.getLogger(__name__)
 
+# Longer lines are split when reading command output
+MAX_LINE_LENGTH = 65536
+# Seconds a database ping may take
+PING_TIMEOUT = 30
+# fcntl.F_SETPIPE_SZ is only exposed from python 3.10
+F_SETPIPE_SZ = getattr(fcntl, 'F_SETPIPE_SZ', 1031)
+
 
 def test():
     return run(['ls', '/volumes'])
@@ -20,7 +35,7 @@ def ping_mysql(host, port, username) -> int:
         port,
         '--user',
         username,
-    ])
+    ], timeout=PING_TIMEOUT)
 
 
 def ping_mariadb(host, port, username) -> int:
@@ -34,7 +49,7 @@ def ping_mariadb(host, port, username) -> int:
         port,
         '--user',
         username,
-    ])
+    ], timeout=PING_TIMEOUT)
 
 
 def ping_postgres(host, port, username, password) -> int:
@@ -44,36 +59,235 @@ def ping_postgres(host, port, username, password) -> int:
         f"--host={host}",
         f"--port={port}",
         f"--username={username}",
-    ])
+    ], timeout=PING_TIMEOUT)
 
 
-def run(cmd: List[str]) -> int:
-    """Run a command with parameters"""
+def list_mysql_databases(host, port, username, environment: dict = None) -> Tuple[int, List[str]]:
+    """Returns the exit code and the names of all databases the user can access"""
+    exit_code, stdout = run_output([
+        'mysql',
+        f'--host={host}',
+        f'--port={port}',
+        f'--user={username}',
+        '--batch',
+        '--skip-column-names',
+        '--execute=SHOW DATABASES',
+    ], environment=environment)
+    return exit_code, [name for name in stdout.splitlines() if name.strip()]
+
+
+class CommandResult:
+    """Exit code, output tail and resource usage of a finished command"""
+    def __init__(self, cmd: List[str], tail_lines: int):
+        self.cmd = cmd
+        self.returncode = None
+        self.stdout = []
+        self.stderr = []
+        # The last lines of stdout for error reporting. stderr is always logged
+        self.tail = deque(maxlen=tail_lines)
+        self.timed_out = False
+        self.duration = 0.0
+        # Peak resident set size in KiB and user + system cpu seconds
+        self.max_rss = 0
+        self.cpu_time = 0.0
+
+
+def execute(cmd: List[str], environment: dict = None, on_stdout: Callable[[str], None] = None,
+            capture: bool = False, timeout: float = None, tail_lines: int = 50) -> CommandResult:
+    """
+    Run a command reading stdout and stderr at the same time line by line.
+
+    Lines are passed to ``on_stdout`` or logged while the command is running
+    (stdout at debug and stderr at error level). Only the last ``tail_lines``
+    lines are kept unless ``capture`` is set. The command is killed if
+    it runs longer than ``timeout`` seconds.
+    Extra ``environment`` variables are only passed to the child process.
+    """
     logger.debug('cmd: %s', ' '.join(cmd))
-    child = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    stdoutdata, stderrdata = child.communicate()
+    env = {**os.environ, **environment} if environment else None
+    result = CommandResult(cmd, tail_lines)
+    start = time.monotonic()
+    child = Popen(cmd, stdout=PIPE, stderr=PIPE, env=env)
+    # Output is logged from the reader threads. Keep it grouped with the calling job
+    records = log.current_capture()
+
+    def reader(stream, handler, captured, tail):
+        with log.capture_into(records):
+            for line in iter(lambda: stream.readline(MAX_LINE_LENGTH), b''):
+                line = line.decode(errors='replace')
+                if tail is not None:
+                    tail.append(line.rstrip('\n'))
+                if capture:
+                    captured.append(line)
+                handler(line)
+        stream.close()
+
+    on_stdout = on_stdout or _log_stdout
+    readers = [
+        threading.Thread(target=reader, daemon=True,
+                         args=(child.stdout, on_stdout, result.stdout, result.tail)),
+        threading.Thread(target=reader, daemon=True,
+                         args=(child.stderr, _log_stderr, result.stderr, None)),
+    ]
+    for thread in readers:
+        thread.start()
+
+    def kill():
+        result.timed_out = True
+        with log.capture_into(records):
+            logger.error('Command timed out after %s seconds: %s', timeout, ' '.join(cmd))
+        child.kill()
+
+    timer = threading.Timer(timeout, kill) if timeout else None
+    if timer:
+        timer.start()
+
+    # wait4 also returns the resource usage of the child
+    _, status, rusage = os.wait4(child.pid, 0)
+    if timer:
+        timer.cancel()
+    for thread in readers:
+        thread.join()
+
+    child.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+    result.returncode = child.returncode
+    result.duration = time.monotonic() - start
+    result.max_rss = rusage.ru_maxrss
+    result.cpu_time = rusage.ru_utime + rusage.ru_stime
+
+    logger.debug("returncode %s in %.1fs, cpu %.1fs, max rss %s",
+                 result.returncode, result.duration, result.cpu_time, utils.format_bytes(result.max_rss * 1024))
+    # stdout passed to a custom handler is not logged
+    if result.returncode != 0 and on_stdout is _log_stdout and result.tail:
+        log_std('stdout', '\n'.join(result.tail), logging.ERROR)
+
+    return result
+
+
+def _log_stdout(line: str):
+    logger.debug(line.rstrip())
+
+
+def _log_stderr(line: str):
+    logger.error(line.rstrip())
 
-    if stdoutdata.strip():
-        log_std('stdout', stdoutdata.decode(),
-                logging.DEBUG if child.returncode == 0 else logging.ERROR)
 
-    if stderrdata.strip():
-        log_std('stderr', stderrdata.decode(), logging.ERROR)
+def run(cmd: List[str], environment: dict = None, timeout: float = None) -> int:
+    """Run a command with parameters"""
+    return execute(cmd, environment=environment, timeout=timeout).returncode
+
+
+def run_output(cmd: List[str], environment: dict = None) -> Tuple[int, str]:
+    """
+    Run a command with parameters returning the exit code and stdout.
+    Extra ``environment`` variables are only passed to the child process.
+    """
+    result = execute(cmd, environment=environment, capture=True)
+    return result.returncode, ''.join(result.stdout)
+
+
+def run_stream(cmd: List[str], on_line: Callable[[str], None], environment: dict = None) -> int:
+    """
+    Run a command passing each line written to stdout to ``on_line``
+    while the command is running. stderr is logged as it is written.
+    """
+    return execute(cmd, environment=environment, on_stdout=on_line).returncode
+
+
+class RelayStats:
+    """Bytes copied by ``relay`` and the time spent waiting on each side"""
+    def __init__(self):
+        self.bytes = 0
+        self.duration = 0.0
+        # Time blocked reading from the source / writing to the destination
+        self.read_wait = 0.0
+        self.write_wait = 0.0
+
+    @property
+    def throughput(self) -> float:
+        """float: Bytes per second"""
+        return self.bytes / self.duration if self.duration else 0.0
+
+    @property
+    def bottleneck(self) -> str:
+        """str: ``source`` if the destination mostly waited for data, otherwise ``destination``"""
+        return 'source' if self.read_wait >= self.write_wait else 'destination'
+
 
-    logger.debug("returncode %s", child.returncode)
-    return child.returncode
+def set_pipe_size(fd: int, size: int) -> int:
+    """
+    Resize a pipe buffer (linux only). Returns the new size or
+    ``None`` if the size could not be changed.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+
+    try:
+        return fcntl.fcntl(fd, F_SETPIPE_SZ, size)
+    except OSError as ex:
+        logger.debug('Unable to resize pipe to %s bytes: %s', size, ex)
+        return None
+
+
+def relay(source, destination, chunk_size: int = 65536) -> RelayStats:
+    """
+    Copy a pipe into another until the source is exhausted or the
+    destination is closed measuring how long each side was waited on.
+    Both pipes are closed when done.
+    """
+    stats = RelayStats()
+    src, dst = source.fileno(), destination.fileno()
+    start = time.monotonic()
+    try:
+        while True:
+            before = time.monotonic()
+            data = os.read(src, chunk_size)
+            after = time.monotonic()
+            stats.read_wait += after - before
+            if not data:
+                break
+
+            view = memoryview(data)
+            while view:
+                view = view[os.write(dst, view):]
+            stats.write_wait += time.monotonic() - after
+            stats.bytes += len(data)
+    except BrokenPipeError:
+        logger.debug('Destination closed the pipe after %s bytes', stats.bytes)
+    finally:
+        stats.duration = time.monotonic() - start
+        source.close()
+        try:
+            destination.close()
+        except BrokenPipeError:
+            pass
+
+    return stats
+
+
+def drain(stream) -> Tuple[threading.Thread, List[bytes]]:
+    """Read a pipe to the end in a background thread. Returns the thread and the list of chunks read"""
+    chunks = []
+
+    def reader():
+        for chunk in iter(lambda: stream.read(65536), b''):
+            chunks.append(chunk)
+        stream.close()
+
+    thread = threading.Thread(target=reader, daemon=True)
+    thread.start()
+    return thread, chunks
 
 
 def run_capture_std(cmd: List[str]) -> Tuple[str, str]:
     """Run a command with parameters and return stdout, stderr"""
-    logger.debug('cmd: %s', ' '.join(cmd))
-    child = Popen(cmd, stdout=PIPE, stderr=PIPE)
-    return child.communicate()
+    result = execute(cmd, capture=True)
+    return ''.join(result.stdout), ''.join(result.stderr)
 
 
 def log_std(source: str, data: str, level: int):
     if isinstance(data, bytes):
-        data = data.decode()
+        data = data.decode(errors='replace')
 
     if not data.strip():
         return
@@ -4,6 +4,10 @@ import os
 class Config:
     default_backup_command = "source /env.sh && rcb backup > /proc/1/fd/1"
     default_crontab_schedule = "0 2 * * *"
+    default_maintenance_command = "source /env.sh && rcb maintenance {} > /proc/1/fd/1"
+    default_prune_schedule = "0 4 * * *"
+    default_check_schedule = "0 5 * * 0"
+    default_cache_cleanup_schedule = "0 6 * * 0"
 
     """Bag for config values"""
     def __init__(self, check=True):
@@ -12,12 +16,89 @@ class Config:
         self.password = os.environ.get('RESTIC_REPOSITORY')
         self.cron_schedule = os.environ.get('CRON_SCHEDULE') or self.default_crontab_schedule
         self.cron_command = os.environ.get('CRON_COMMAND') or self.default_backup_command
+        self.prune_schedule = os.environ.get('PRUNE_SCHEDULE') or self.default_prune_schedule
+        self.check_schedule = os.environ.get('CHECK_SCHEDULE') or self.default_check_schedule
+        self.cache_cleanup_schedule = (
+            os.environ.get('CACHE_CLEANUP_SCHEDULE') or self.default_cache_cleanup_schedule
+        )
         self.swarm_mode = os.environ.get('SWARM_MODE') or False
         self.include_project_name = os.environ.get('INCLUDE_PROJECT_NAME') or False
         self.exclude_bind_mounts = os.environ.get('EXCLUDE_BIND_MOUNTS') or False
 
+        # rcb swarm-backup: agents running at the same time and seconds to wait for each agent
+        self.swarm_concurrency = int(os.environ.get('SWARM_CONCURRENCY') or 4)
+        self.swarm_agent_timeout = int(os.environ.get('SWARM_AGENT_TIMEOUT') or 6 * 3600)
+
+        # Docker api client
+        self.docker_timeout = int(os.environ.get('DOCKER_TIMEOUT') or 60)
+        self.docker_pool_size = int(os.environ.get('DOCKER_POOL_SIZE') or 10)
+
+        # How many database dumps can run at the same time
+        self.database_backup_concurrency = int(os.environ.get('DATABASE_BACKUP_CONCURRENCY') or 1)
+
+        # One restic session and snapshot per service or volume, or a single one of /volumes with none
+        self.volume_backup_split = (os.environ.get('VOLUME_BACKUP_SPLIT') or 'service').strip().lower()
+        self.volume_backup_concurrency = int(os.environ.get('VOLUME_BACKUP_CONCURRENCY') or 1)
+
+        # default or dedup. The dedup profile makes dumps stable between runs
+        self.database_dump_profile = os.environ.get('DATABASE_DUMP_PROFILE') or 'default'
+
+        # Scratch directory for directory format database dumps
+        self.database_dump_dir = os.environ.get('DATABASE_DUMP_DIR') or '/databases'
+
+        # Prometheus textfile directory and optional http port for rcb metrics-server
+        self.metrics_dir = os.environ.get('METRICS_DIR')
+        self.metrics_port = int(os.environ.get('METRICS_PORT') or 0)
+
+        # Restic cache passed with --cache-dir. Mounted as a named volume in the
+        # backup process container unless the backup service already has a mount for it
+        self.cache_dir = os.environ.get('CACHE_DIR') or '/cache/restic'
+
+        # Skip volume units that have not changed since their last snapshot
+        self.volume_fingerprints = os.environ.get('VOLUME_FINGERPRINTS') or False
+        self.fingerprint_workers = int(os.environ.get('FINGERPRINT_WORKERS') or 8)
+
+        # Host recorded in every snapshot. The backup command passes the project name if not set
+        self.restic_host = os.environ.get('RESTIC_HOST')
+        # Look up and pass the parent snapshot explicitly for every backup unit
+        self.parent_snapshot_lookup = os.environ.get('PARENT_SNAPSHOT_LOOKUP') or False
+        self.cache_volume = os.environ.get('CACHE_VOLUME')
+
+        # Files persisted between runs such as the time of the last prune
+        self.state_dir = os.environ.get('STATE_DIR') or '/cache/rcb'
+
+        # Projects sharing a repository coordinate through lock files in a directory they all mount
+        self.lock_dir = os.environ.get('LOCK_DIR') or os.path.join(self.state_dir, 'locks')
+        # Seconds to wait for the repository lock. 0 waits forever
+        self.lock_timeout = int(os.environ.get('LOCK_TIMEOUT') or 6 * 3600)
+
+        # Scheduled prunes are skipped until enough time has passed or enough snapshots are forgotten
+        self.prune_min_hours = int(os.environ.get('PRUNE_MIN_HOURS') or 168)
+        self.prune_min_forgotten = int(os.environ.get('PRUNE_MIN_FORGOTTEN') or 0)
+
+        # Read 1/N of the pack data in every scheduled check. 0 only checks the structure
+        self.check_read_data_subsets = int(os.environ.get('CHECK_READ_DATA_SUBSETS') or 0)
+
+        # Kernel pipe buffer size between database dumps and restic
+        self.pipe_size = int(os.environ.get('PIPE_SIZE') or 1024 * 1024)
+
+        # Output of the backup process container. Only the tail is kept in memory for alerts
+        self.backup_log = os.environ.get('BACKUP_LOG') or 'backup.log'
+        self.backup_log_keep = int(os.environ.get('BACKUP_LOG_KEEP') or 1)
+        self.backup_log_compress = os.environ.get('BACKUP_LOG_COMPRESS') or False
+        self.backup_log_tail = int(os.environ.get('BACKUP_LOG_TAIL') or 200)
+
+        # Alerts are sent in the background with a timeout and retries per backend
+        self.alert_timeout = float(os.environ.get('ALERT_TIMEOUT') or 10)
+        self.alert_retries = int(os.environ.get('ALERT_RETRIES') or 3)
+        self.alert_backoff = float(os.environ.get('ALERT_BACKOFF') or 2)
+        # Seconds to wait for pending alerts when the process exits
+        self.alert_flush_timeout = float(os.environ.get('ALERT_FLUSH_TIMEOUT') or 60)
+
         # Log
         self.log_level = os.environ.get('LOG_LEVEL')
+        # Seconds between restic progress lines
+        self.progress_interval = int(os.environ.get('PROGRESS_INTERVAL') or 60)
 
         # forget / keep
         self.keep_daily = os.environ.get('KEEP_DAILY') or "7"
@@ -13,8 +13,19 @@ VOLUME_TYPE_VOLUME = "volume"
 
 
 class Container:
-    """Represents a docker container"""
+    """
+    Represents a docker container.
+
+    Labels, flags and include/exclude patterns are parsed once on
+    creation and the environment on first use.
+    """
     container_type = None
+    # Names of the environment variables in the container holding credentials
+    credentials_env = ()
+    __slots__ = (
+        '_data', '_state', '_config', '_mounts', '_labels', '_env',
+        '_include', '_exclude', '_flags', '_concurrency', '_instance',
+    )
 
     def __init__(self, data: dict):
         self._data = data
@@ -33,21 +44,37 @@ class Container:
 
         self._include = self._parse_pattern(self.get_label(enums.LABEL_VOLUMES_INCLUDE))
         self._exclude = self._parse_pattern(self.get_label(enums.LABEL_VOLUMES_EXCLUDE))
+        self._flags = {
+            label: utils.is_true(self.get_label(label))
+            for label in (
+                enums.LABEL_VOLUMES_ENABLED,
+                enums.LABEL_MYSQL_ENABLED,
+                enums.LABEL_MARIADB_ENABLED,
+                enums.LABEL_POSTGRES_ENABLED,
+            )
+        }
+        self._concurrency = self._parse_concurrency(self._labels.get(enums.LABEL_CONCURRENCY))
+        self._env = None
+        self._instance = None
 
     @property
     def instance(self) -> 'Container':
         """Container: Get a service specific subclass instance"""
         # TODO: Do this smarter in the future (simple registry)
+        if self._instance is not None:
+            return self._instance
+
+        self._instance = self
         if self.database_backup_enabled:
             from restic_compose_backup import containers_db
             if self.mariadb_backup_enabled:
-                return containers_db.MariadbContainer(self._data)
-            if self.mysql_backup_enabled:
-                return containers_db.MysqlContainer(self._data)
-            if self.postgresql_backup_enabled:
-                return containers_db.PostgresContainer(self._data)
-        else:
-            return self
+                self._instance = containers_db.MariadbContainer(self._data)
+            elif self.mysql_backup_enabled:
+                self._instance = containers_db.MysqlContainer(self._data)
+            elif self.postgresql_backup_enabled:
+                self._instance = containers_db.PostgresContainer(self._data)
+
+        return self._instance
 
     @property
     def id(self) -> str:
@@ -105,9 +132,10 @@ class Container:
 
     def get_config_env(self, name) -> str:
         """Get a config environment variable by name"""
-        # convert to dict and fetch env var by name
-        data = {i[0:i.find('=')]: i[i.find('=') + 1:] for i in self.environment}
-        return data.get(name)
+        # convert to dict once and fetch env var by name
+        if self._env is None:
+            self._env = {i[0:i.find('=')]: i[i.find('=') + 1:] for i in self.environment or []}
+        return self._env.get(name)
 
     def set_config_env(self, name, value):
         """Set an environment variable"""
@@ -120,6 +148,14 @@ class Container:
         else:
             env.append(new_value)
 
+        if self._env is not None:
+            self._env[name] = str(value)
+
+    @property
+    def mounts(self) -> List['Mount']:
+        """List[Mount]: All mounts of the container"""
+        return self._mounts
+
     @property
     def volumes(self) -> dict:
         """
@@ -138,39 +174,52 @@ class Container:
     @property
     def backup_enabled(self) -> bool:
         """Is backup enabled for this container?"""
-        return any([
-            self.volume_backup_enabled,
-            self.database_backup_enabled,
-        ])
+        return self.volume_backup_enabled or self.database_backup_enabled
 
     @property
     def volume_backup_enabled(self) -> bool:
         """bool: If the ``restic-compose-backup.volumes`` label is set"""
-        return utils.is_true(self.get_label(enums.LABEL_VOLUMES_ENABLED))
+        return self._flags[enums.LABEL_VOLUMES_ENABLED]
 
     @property
     def database_backup_enabled(self) -> bool:
         """bool: Is database backup enabled in any shape or form?"""
-        return any([
-            self.mysql_backup_enabled,
-            self.mariadb_backup_enabled,
-            self.postgresql_backup_enabled,
-        ])
+        return self.mysql_backup_enabled or self.mariadb_backup_enabled or self.postgresql_backup_enabled
 
     @property
     def mysql_backup_enabled(self) -> bool:
         """bool: If the ``restic-compose-backup.mysql`` label is set"""
-        return utils.is_true(self.get_label(enums.LABEL_MYSQL_ENABLED))
+        return self._flags[enums.LABEL_MYSQL_ENABLED]
 
     @property
     def mariadb_backup_enabled(self) -> bool:
         """bool: If the ``restic-compose-backup.mariadb`` label is set"""
-        return utils.is_true(self.get_label(enums.LABEL_MARIADB_ENABLED))
+        return self._flags[enums.LABEL_MARIADB_ENABLED]
 
     @property
     def postgresql_backup_enabled(self) -> bool:
         """bool: If the ``restic-compose-backup.postgres`` label is set"""
-        return utils.is_true(self.get_label(enums.LABEL_POSTGRES_ENABLED))
+        return self._flags[enums.LABEL_POSTGRES_ENABLED]
+
+    @property
+    def concurrency(self) -> int:
+        """int: Pool slots a backup of this service occupies (``restic-compose-backup.concurrency`` label)"""
+        return self._concurrency
+
+    @property
+    def dump_profile(self) -> str:
+        """str: The database dump profile from the ``restic-compose-backup.dump.profile`` label or config"""
+        return (self.get_label(enums.LABEL_DUMP_PROFILE) or config.database_dump_profile).strip().lower()
+
+    def backup_tags(self, unit_type: str = None) -> List[str]:
+        """List[str]: Snapshot tags for a backup unit of this service"""
+        tags = [
+            f'{enums.TAG_PROJECT}={self.project_name}',
+            f'{enums.TAG_SERVICE}={self.service_name}',
+            f'{enums.TAG_TYPE}={unit_type or self.container_type}',
+            f'{enums.TAG_IMAGE}={self.image}',
+        ]
+        return [tag for tag in tags if not tag.endswith('=')]
 
     @property
     def is_backup_process_container(self) -> bool:
@@ -190,6 +239,15 @@ class Container:
         """Get a label by name"""
         return self._labels.get(name, None)
 
+    def get_mount(self, path: str) -> 'Mount':
+        """Mount: The mount containing the path or ``None``"""
+        path = path.rstrip('/') + '/'
+        for mount in self._mounts:
+            if path.startswith(mount.destination.rstrip('/') + '/'):
+                return mount
+
+        return None
+
     def filter_mounts(self):
         """Get all mounts for this container matching include/exclude filters"""
         filtered = []
@@ -235,8 +293,8 @@ class Container:
 
         return volumes
 
-    def get_volume_backup_destination(self, mount, source_prefix) -> str:
-        """Get the destination path for backups of the given mount"""
+    def get_volume_backup_root(self, source_prefix) -> str:
+        """Get the directory all volume backups for this service are placed in"""
         destination = Path(source_prefix)
 
         if utils.is_true(config.include_project_name):
@@ -245,6 +303,11 @@ class Container:
                 destination /= project_name
 
         destination /= self.service_name
+        return str(destination)
+
+    def get_volume_backup_destination(self, mount, source_prefix) -> str:
+        """Get the destination path for backups of the given mount"""
+        destination = Path(self.get_volume_backup_root(source_prefix))
         destination /= Path(utils.strip_root(mount.destination))
 
         return str(destination)
@@ -258,7 +321,7 @@ class Container:
         raise NotImplementedError("Base container class don't implement this")
 
     def backup(self):
-        """Back up this service"""
+        """Back up this service. Returns the exit code or a tuple with the exit code and a summary"""
         raise NotImplementedError("Base container class don't implement this")
 
     def backup_destination_path(self) -> str:
@@ -283,6 +346,25 @@ class Container:
 
         return value.split(',')
 
+    def _parse_concurrency(self, value) -> int:
+        """int: Parse the concurrency label. Missing or invalid values are 1"""
+        if value is None:
+            return 1
+
+        try:
+            concurrency = int(value)
+        except ValueError:
+            logger.warning("Invalid value '%s' for label %s in service %s. Using 1",
+                           value, enums.LABEL_CONCURRENCY, self.service_name)
+            return 1
+
+        if concurrency < 1:
+            logger.warning("Label %s in service %s must be at least 1. Using 1",
+                           enums.LABEL_CONCURRENCY, self.service_name)
+            return 1
+
+        return concurrency
+
     def __eq__(self, other):
         """Compare container by id"""
         if other is None:
@@ -302,6 +384,8 @@ class Container:
 
 class Mount:
     """Represents a volume mount (volume or bind)"""
+    __slots__ = ('_data', '_container')
+
     def __init__(self, data, container=None):
         self._data = data
         self._container = container
@@ -350,25 +434,35 @@ class Mount:
 class RunningContainers:
 
     def __init__(self):
-        all_containers = utils.list_containers()
+        all_containers = [
+            Container(data)
+            for data in utils.list_containers(
+                hostname=os.environ['HOSTNAME'],
+                swarm_mode=bool(config.swarm_mode),
+            )
+        ]
         self.containers = []
         self.this_container = None
         self.backup_process_container = None
         self.stale_backup_process_containers = []
 
+        # Indexes over self.containers
+        self._by_id = {}
+        self._by_service = {}
+        self._by_project = {}
+        self._for_backup = []
+
         # Find the container we are running in.
         # If we don't have this information we cannot continue
-        for container_data in all_containers:
-            if container_data.get('Id').startswith(os.environ['HOSTNAME']):
-                self.this_container = Container(container_data)
+        for container in all_containers:
+            if container.id.startswith(os.environ['HOSTNAME']):
+                self.this_container = container
 
         if not self.this_container:
             raise ValueError("Cannot find metadata for backup container")
 
         # Gather all running containers in the current compose setup
-        for container_data in all_containers:
-            container = Container(container_data)
-
+        for container in all_containers:
             # Gather stale backup process containers
             if (self.this_container.image == container.image
                     and not container.is_running
@@ -398,13 +492,27 @@ class RunningContainers:
             if container == self.backup_process_container:
                 continue
 
-            self.containers.append(container)
+            self.add(container)
+
+    def add(self, container: Container):
+        """Add a container to the evaluated containers and indexes"""
+        self.containers.append(container)
+        self._by_id[container.id] = container
+        self._by_service.setdefault(container.service_name, container)
+        self._by_project.setdefault(container.project_name, []).append(container)
+        if container.backup_enabled:
+            self._for_backup.append(container)
 
     @property
     def project_name(self) -> str:
         """str: Name of the compose project"""
         return self.this_container.project_name
 
+    @property
+    def stable_name(self) -> str:
+        """str: Name of the compose project or swarm stack. Never empty"""
+        return self.project_name or self.this_container.stack_name or enums.DEFAULT_NAME
+
     @property
     def backup_process_label(self) -> str:
         """str: The backup process label for this project"""
@@ -417,7 +525,7 @@ class RunningContainers:
 
     def containers_for_backup(self):
         """Obtain all containers with backup enabled"""
-        return [container for container in self.containers if container.backup_enabled]
+        return list(self._for_backup)
 
     def generate_backup_mounts(self, dest_prefix='/volumes') -> dict:
         """Generate mounts for backup for the entire compose setup"""
@@ -428,10 +536,43 @@ class RunningContainers:
 
         return mounts
 
+    def generate_backup_units(self, dest_prefix='/volumes', split=None) -> List[dict]:
+        """
+        Generate the units each running a separate restic backup session
+        recorded as its own snapshot. Each unit is a dict with the ``path``
+        to back up and the snapshot ``tags``.
+
+        Args:
+            dest_prefix (str): The path volumes are mounted under
+            split (str): ``service`` for one unit per service, ``volume``
+                for one unit per volume or ``None`` for a single unit
+        """
+        units = {}
+        for container in self.containers_for_backup():
+            if not container.volume_backup_enabled:
+                continue
+
+            for mount in container.filter_mounts():
+                tags = container.backup_tags(enums.UNIT_TYPE_VOLUME)
+                if split == enums.VOLUME_SPLIT_SERVICE:
+                    path = container.get_volume_backup_root(dest_prefix)
+                elif split == enums.VOLUME_SPLIT_VOLUME:
+                    path = container.get_volume_backup_destination(mount, dest_prefix)
+                else:
+                    path = dest_prefix
+                    tags = [f'{enums.TAG_PROJECT}={self.project_name}', f'{enums.TAG_TYPE}={enums.UNIT_TYPE_VOLUME}']
+                units[path] = {'path': path, 'tags': tags}
+
+        return list(units.values())
+
     def get_service(self, name) -> Container:
         """Container: Get a service by name"""
-        for container in self.containers:
-            if container.service_name == name:
-                return container
+        return self._by_service.get(name)
 
-        return None
+    def get_container(self, container_id) -> Container:
+        """Container: Get a container by id"""
+        return self._by_id.get(container_id)
+
+    def get_project(self, name) -> List[Container]:
+        """List[Container]: Get all containers in a compose project"""
+        return list(self._by_project.get(name, []))
@@ -1,16 +1,36 @@
+import logging
+import shutil
+from fnmatch import fnmatch
 from pathlib import Path
+from typing import List
 
 from restic_compose_backup.containers import Container
 from restic_compose_backup.config import config, Config
 from restic_compose_backup import (
     commands,
+    enums,
+    jobs,
     restic,
 )
 from restic_compose_backup import utils
 
+logger = logging.getLogger(__name__)
 
-class MariadbContainer(Container):
-    container_type = 'mariadb'
+
+class MysqlContainer(Container):
+    container_type = 'mysql'
+    credentials_env = ('MYSQL_USER', 'MYSQL_PASSWORD')
+    # Never dumped when splitting databases
+    system_databases = ('information_schema', 'performance_schema', 'sys')
+    # Stable output between runs: no dump date or server comments,
+    # rows ordered by primary key and one row per INSERT statement
+    dedup_options = (
+        "--skip-dump-date",
+        "--skip-comments",
+        "--order-by-primary",
+        "--skip-extended-insert",
+    )
+    __slots__ = ()
 
     def get_credentials(self) -> dict:
         """dict: get credentials for the service"""
@@ -21,18 +41,23 @@ class MariadbContainer(Container):
             'port': "3306",
         }
 
+    @property
+    def split_databases(self) -> bool:
+        """bool: If the ``restic-compose-backup.databases.split`` label is set"""
+        return utils.is_true(self.get_label(enums.LABEL_DATABASES_SPLIT))
+
     def ping(self) -> bool:
         """Check the availability of the service"""
         creds = self.get_credentials()
 
         with utils.environment('MYSQL_PWD', creds['password']):
-            return commands.ping_mariadb(
+            return commands.ping_mysql(
                 creds['host'],
                 creds['port'],
                 creds['username'],
             )
 
-    def dump_command(self) -> list:
+    def dump_command(self, database: str = None) -> list:
         """list: create a dump command restic and use to send data through stdin"""
         creds = self.get_credentials()
         return [
@@ -40,22 +65,91 @@ class MariadbContainer(Container):
             f"--host={creds['host']}",
             f"--port={creds['port']}",
             f"--user={creds['username']}",
-            "--all-databases",
+            *(["--databases", database] if database else ["--all-databases"]),
             "--no-tablespaces",
+            *(self.dedup_options if self.dump_profile == enums.DUMP_PROFILE_DEDUP else []),
         ]
 
+    def databases_for_backup(self) -> List[str]:
+        """
+        List databases in the service matching the
+        ``restic-compose-backup.databases.include/exclude`` labels.
+        Returns ``None`` if the databases could not be listed.
+        """
+        creds = self.get_credentials()
+        exit_code, databases = commands.list_mysql_databases(
+            creds['host'],
+            creds['port'],
+            creds['username'],
+            environment={'MYSQL_PWD': creds['password']},
+        )
+        if exit_code != 0:
+            logger.error('Failed to list databases in service %s', self.service_name)
+            return None
+
+        include = self._parse_pattern(self.get_label(enums.LABEL_DATABASES_INCLUDE))
+        exclude = self._parse_pattern(self.get_label(enums.LABEL_DATABASES_EXCLUDE))
+
+        selected = []
+        for name in databases:
+            if name in self.system_databases:
+                continue
+            if include and not any(fnmatch(name, pattern.strip()) for pattern in include):
+                continue
+            if exclude and any(fnmatch(name, pattern.strip()) for pattern in exclude):
+                continue
+            selected.append(name)
+
+        return selected
+
     def backup(self):
         config = Config()
+        if self.split_databases:
+            return self.backup_split(config)
+
+        creds = self.get_credentials()
+        return restic.backup_from_stdin(
+            config.repository,
+            self.backup_destination_path(),
+            self.dump_command(),
+            environment={'MYSQL_PWD': creds['password']},
+            with_summary=True,
+            tags=self.backup_tags(),
+        )
+
+    def backup_split(self, config: Config) -> int:
+        """Dump each database into its own file running up to ``concurrency`` dumps at the same time"""
+        databases = self.databases_for_backup()
+        if databases is None:
+            return 1
+
         creds = self.get_credentials()
+        logger.info('Dumping %s databases in service %s', len(databases), self.service_name)
 
-        with utils.environment('MYSQL_PWD', creds['password']):
+        def dump(database):
             return restic.backup_from_stdin(
                 config.repository,
-                self.backup_destination_path(),
-                self.dump_command(),
+                self.backup_destination_path(database),
+                self.dump_command(database),
+                environment={'MYSQL_PWD': creds['password']},
+                with_summary=True,
+                tags=self.backup_tags(),
             )
 
-    def backup_destination_path(self) -> str:
+        results = jobs.run(
+            [jobs.Job(f'database {name} in service {self.service_name}', lambda name=name: dump(name))
+             for name in databases],
+            self.concurrency,
+        )
+        for result in results:
+            logger.info('Dump of %s: exit code %s, %s',
+                        result.name, result.exit_code, restic.format_summary(result.summary))
+            if not result.ok:
+                logger.error('Dump of %s exited with non-zero code: %s', result.name, result.exit_code)
+
+        return 0 if all(result.ok for result in results) else 1
+
+    def backup_destination_path(self, database: str = None) -> str:
         destination = Path("/databases")
 
         if utils.is_true(config.include_project_name):
@@ -64,73 +158,41 @@ class MariadbContainer(Container):
                 destination /= project_name
 
         destination /= self.service_name
-        destination /= "all_databases.sql"
+        if database:
+            destination /= f"{database}.sql"
+        elif self.split_databases:
+            destination /= "*.sql"
+        else:
+            destination /= "all_databases.sql"
 
         return destination
 
 
-class MysqlContainer(Container):
-    container_type = 'mysql'
-
-    def get_credentials(self) -> dict:
-        """dict: get credentials for the service"""
-        return {
-            'host': self.hostname,
-            'username': self.get_config_env('MYSQL_USER'),
-            'password': self.get_config_env('MYSQL_PASSWORD'),
-            'port': "3306",
-        }
+class MariadbContainer(MysqlContainer):
+    container_type = 'mariadb'
+    __slots__ = ()
 
     def ping(self) -> bool:
         """Check the availability of the service"""
         creds = self.get_credentials()
 
         with utils.environment('MYSQL_PWD', creds['password']):
-            return commands.ping_mysql(
+            return commands.ping_mariadb(
                 creds['host'],
                 creds['port'],
                 creds['username'],
             )
 
-    def dump_command(self) -> list:
-        """list: create a dump command restic and use to send data through stdin"""
-        creds = self.get_credentials()
-        return [
-            "mysqldump",
-            f"--host={creds['host']}",
-            f"--port={creds['port']}",
-            f"--user={creds['username']}",
-            "--all-databases",
-            "--no-tablespaces",
-        ]
-
-    def backup(self):
-        config = Config()
-        creds = self.get_credentials()
-
-        with utils.environment('MYSQL_PWD', creds['password']):
-            return restic.backup_from_stdin(
-                config.repository,
-                self.backup_destination_path(),
-                self.dump_command(),
-            )
-
-    def backup_destination_path(self) -> str:
-        destination = Path("/databases")
-
-        if utils.is_true(config.include_project_name):
-            project_name = self.project_name
-            if project_name != "":
-                destination /= project_name
-
-        destination /= self.service_name
-        destination /= "all_databases.sql"
-
-        return destination
-
 
 class PostgresContainer(Container):
     container_type = 'postgres'
+    credentials_env = ('POSTGRES_USER', 'POSTGRES_PASSWORD', 'POSTGRES_DB')
+    # pg_dump has no timestamps in its output and writes one row per line.
+    # Quoting all identifiers keeps the output stable across server upgrades.
+    dedup_options = (
+        "--quote-all-identifiers",
+    )
+    __slots__ = ()
 
     def get_credentials(self) -> dict:
         """dict: get credentials for the service"""
@@ -142,6 +204,11 @@ class PostgresContainer(Container):
             'database': self.get_config_env('POSTGRES_DB'),
         }
 
+    @property
+    def directory_format(self) -> bool:
+        """bool: If the ``restic-compose-backup.postgres.directory`` label is set"""
+        return utils.is_true(self.get_label(enums.LABEL_POSTGRES_DIRECTORY))
+
     def ping(self) -> bool:
         """Check the availability of the service"""
         creds = self.get_credentials()
@@ -161,22 +228,98 @@ class PostgresContainer(Container):
             f"--host={creds['host']}",
             f"--port={creds['port']}",
             f"--username={creds['username']}",
+            *(self.dedup_options if self.dump_profile == enums.DUMP_PROFILE_DEDUP else []),
             creds['database'],
         ]
 
+    def dump_directory_command(self, path: Path) -> list:
+        """list: dump command writing a directory format dump using ``concurrency`` jobs"""
+        creds = self.get_credentials()
+        return [
+            "pg_dump",
+            f"--host={creds['host']}",
+            f"--port={creds['port']}",
+            f"--username={creds['username']}",
+            "--format=directory",
+            # Compressed table files change completely on every run and restic cannot deduplicate them
+            "--compress=0",
+            f"--jobs={self.concurrency}",
+            f"--file={path}",
+            creds['database'],
+        ]
+
+    def restore_directory_command(self, path: Path) -> list:
+        """list: restore command for a directory format dump using ``concurrency`` jobs"""
+        creds = self.get_credentials()
+        return [
+            "pg_restore",
+            f"--host={creds['host']}",
+            f"--port={creds['port']}",
+            f"--username={creds['username']}",
+            f"--dbname={creds['database']}",
+            f"--jobs={self.concurrency}",
+            "--clean",
+            "--if-exists",
+            str(path),
+        ]
+
     def backup(self):
         config = Config()
+        if self.directory_format:
+            return self.backup_directory(config)
+
         creds = self.get_credentials()
+        return restic.backup_from_stdin(
+            config.repository,
+            self.backup_destination_path(),
+            self.dump_command(),
+            environment={'PGPASSWORD': creds['password']},
+            with_summary=True,
+            tags=self.backup_tags(),
+        )
 
-        with utils.environment('PGPASSWORD', creds['password']):
-            return restic.backup_from_stdin(
-                config.repository,
-                self.backup_destination_path(),
-                self.dump_command(),
-            )
+    def backup_directory(self, config: Config) -> int:
+        """Dump to a scratch directory with parallel jobs, back it up and remove it"""
+        creds = self.get_credentials()
+        path = self.backup_destination_path()
+        shutil.rmtree(path, ignore_errors=True)
+        path.parent.mkdir(parents=True, exist_ok=True)
+        if utils.is_on_root_filesystem(path):
+            logger.warning('%s is not on a mounted volume. The dump is written to the container filesystem. '
+                           'Mount a volume at DATABASE_DUMP_DIR', config.database_dump_dir)
+
+        try:
+            logger.info('Dumping %s to %s using %s jobs', creds['database'], path, self.concurrency)
+            exit_code = commands.run(self.dump_directory_command(path), environment={'PGPASSWORD': creds['password']})
+            if exit_code != 0:
+                logger.error('pg_dump exited with non-zero code: %s', exit_code)
+                return exit_code
+
+            return restic.backup_files(config.repository, source=str(path), with_summary=True,
+                                       tags=self.backup_tags())
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def restore_directory(self, config: Config, snapshot: str = 'latest') -> int:
+        """Restore a directory format dump from restic and load it with parallel jobs"""
+        creds = self.get_credentials()
+        path = self.backup_destination_path()
+        shutil.rmtree(path, ignore_errors=True)
 
-    def backup_destination_path(self) -> str:
-        destination = Path("/databases")
+        try:
+            logger.info('Restoring %s from snapshot %s', path, snapshot)
+            exit_code = restic.restore(config.repository, snapshot, str(path))
+            if exit_code != 0:
+                logger.error('restic restore exited with non-zero code: %s', exit_code)
+                return exit_code
+
+            logger.info('Loading %s into %s using %s jobs', path, creds['database'], self.concurrency)
+            return commands.run(self.restore_directory_command(path), environment={'PGPASSWORD': creds['password']})
+        finally:
+            shutil.rmtree(path, ignore_errors=True)
+
+    def backup_destination_path(self) -> Path:
+        destination = Path(config.database_dump_dir if self.directory_format else "/databases")
 
         if utils.is_true(config.include_project_name):
             project_name = self.project_name
@@ -184,6 +327,9 @@ class PostgresContainer(Container):
                 destination /= project_name
 
         destination /= self.service_name
-        destination /= f"{self.get_credentials()['database']}.sql"
+        if self.directory_format:
+            destination /= self.get_credentials()['database']
+        else:
+            destination /= f"{self.get_credentials()['database']}.sql"
 
         return destination
@@ -13,17 +13,34 @@ QUOTE_CHARS = ['"', "'"]
 
 
 def generate_crontab(config):
-    """Generate a crontab entry for running backup job"""
-    command = config.cron_command.strip()
-    schedule = config.cron_schedule
+    """Generate crontab entries for the backup job and the maintenance jobs"""
+    entries = [
+        (config.cron_schedule, config.default_crontab_schedule, config.cron_command),
+        (config.prune_schedule, config.default_prune_schedule, config.default_maintenance_command.format('--prune')),
+        (config.check_schedule, config.default_check_schedule, config.default_maintenance_command.format('--check')),
+        (
+            config.cache_cleanup_schedule,
+            config.default_cache_cleanup_schedule,
+            config.default_maintenance_command.format('--cleanup-cache'),
+        ),
+    ]
+    return ''.join(
+        generate_entry(schedule, default, command)
+        for schedule, default, command in entries
+    )
+
+
+def generate_entry(schedule: str, default: str, command: str):
+    """Generate a single crontab line falling back to the default schedule if invalid"""
+    command = command.strip()
 
     if schedule:
         schedule = schedule.strip()
         schedule = strip_quotes(schedule)
         if not validate_schedule(schedule):
-            schedule = config.default_crontab_schedule
+            schedule = default
     else:
-        schedule = config.default_crontab_schedule
+        schedule = default
 
     return f'{schedule} {command}\n'
 
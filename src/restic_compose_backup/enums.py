@@ -1,5 +1,6 @@
 
 # Labels
+LABEL_PREFIX = 'restic-compose-backup.'
 LABEL_VOLUMES_ENABLED = 'restic-compose-backup.volumes'
 LABEL_VOLUMES_INCLUDE = 'restic-compose-backup.volumes.include'
 LABEL_VOLUMES_EXCLUDE = 'restic-compose-backup.volumes.exclude'
@@ -8,4 +9,38 @@ LABEL_MYSQL_ENABLED = 'restic-compose-backup.mysql'
 LABEL_POSTGRES_ENABLED = 'restic-compose-backup.postgres'
 LABEL_MARIADB_ENABLED = 'restic-compose-backup.mariadb'
 
+LABEL_POSTGRES_DIRECTORY = 'restic-compose-backup.postgres.directory'
+
+LABEL_DUMP_PROFILE = 'restic-compose-backup.dump.profile'
+
+LABEL_DATABASES_SPLIT = 'restic-compose-backup.databases.split'
+LABEL_DATABASES_INCLUDE = 'restic-compose-backup.databases.include'
+LABEL_DATABASES_EXCLUDE = 'restic-compose-backup.databases.exclude'
+
+LABEL_CONCURRENCY = 'restic-compose-backup.concurrency'
+
 LABEL_BACKUP_PROCESS = 'restic-compose-backup.process'
+LABEL_SWARM_AGENT = 'restic-compose-backup.agent'
+
+# Volume backup split modes
+VOLUME_SPLIT_SERVICE = 'service'
+VOLUME_SPLIT_VOLUME = 'volume'
+
+# Snapshot tags identifying each backup unit. The image tag is informational
+# and not used when selecting snapshots to forget
+TAG_PROJECT = 'project'
+TAG_SERVICE = 'service'
+TAG_TYPE = 'type'
+TAG_IMAGE = 'image'
+UNIT_TYPE_VOLUME = 'volume'
+
+# Name used for the restic host and cache volume when the backup
+# service is neither in a compose project nor in a swarm stack
+DEFAULT_NAME = 'restic_compose_backup'
+
+# Environment variable holding the backup plan for the backup process container
+ENV_BACKUP_PLAN = 'BACKUP_PLAN'
+
+# Database dump profiles
+DUMP_PROFILE_DEFAULT = 'default'
+DUMP_PROFILE_DEDUP = 'dedup'
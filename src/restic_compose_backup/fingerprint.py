@@ -0,0 +1,75 @@
+"""
+Cheap fingerprints of volume directories used to skip
+volumes that have not changed since their last snapshot.
+"""
+import hashlib
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def scan(path: str, workers: int = 8) -> dict:
+    """
+    Walk a directory tree with parallel ``os.scandir`` calls.
+
+    Returns:
+        dict with the ``digest`` of all paths, mtimes and sizes,
+        the number of ``files`` and their total ``size`` or
+        ``None`` if any directory could not be read
+    """
+    digests = []
+    files, size = 0, 0
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        pending = {executor.submit(scan_directory, path)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                try:
+                    directory, digest, dir_files, dir_size, subdirs = future.result()
+                except OSError as ex:
+                    logger.warning('Unable to fingerprint %s: %s', path, ex)
+                    for other in pending:
+                        other.cancel()
+                    return None
+
+                digests.append((directory, digest))
+                files += dir_files
+                size += dir_size
+                pending.update(executor.submit(scan_directory, subdir) for subdir in subdirs)
+
+    total = hashlib.sha1()
+    for directory, digest in sorted(digests):
+        total.update(os.fsencode(directory))
+        total.update(digest)
+
+    return {'digest': total.hexdigest(), 'files': files, 'size': size}
+
+
+def scan_directory(path: str) -> Tuple[str, bytes, int, int, List[str]]:
+    """Fingerprint the entries of a single directory returning its subdirectories"""
+    entries, subdirs = [], []
+    files, size = 0, 0
+    stat = os.stat(path, follow_symlinks=False)
+    entries.append(('.', stat.st_mtime_ns, 0))
+
+    with os.scandir(path) as it:
+        for entry in it:
+            stat = entry.stat(follow_symlinks=False)
+            if entry.is_dir(follow_symlinks=False):
+                subdirs.append(entry.path)
+                entries.append((entry.name, stat.st_mtime_ns, 0))
+            else:
+                files += 1
+                size += stat.st_size
+                entries.append((entry.name, stat.st_mtime_ns, stat.st_size))
+
+    digest = hashlib.sha1()
+    for name, mtime, entry_size in sorted(entries):
+        digest.update(os.fsencode(name))
+        digest.update(b'\0%d\0%d\n' % (mtime, entry_size))
+
+    return path, digest.digest(), files, size, subdirs
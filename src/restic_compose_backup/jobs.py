@@ -0,0 +1,121 @@
+"""
+Bounded worker pool for running backup units concurrently
+"""
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, List
+
+from restic_compose_backup import log
+
+logger = logging.getLogger(__name__)
+
+
+class Job:
+    """
+    A named unit of work. The function returns an exit code
+    or a tuple with the exit code and a summary dict.
+    """
+    def __init__(self, name: str, func: Callable[[], int], weight: int = 1):
+        self.name = name
+        self.func = func
+        # The number of pool slots this job occupies while running
+        self.weight = max(1, weight)
+
+
+class JobResult:
+    """The outcome of a job including the log records it emitted"""
+    def __init__(self, name: str, exit_code: int, duration: float, summary: dict = None):
+        self.name = name
+        self.exit_code = exit_code
+        self.duration = duration
+        self.summary = summary
+        self.records = []
+
+    @property
+    def ok(self) -> bool:
+        """bool: Did the job exit with code 0?"""
+        return self.exit_code == 0
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return "<JobResult {} exit_code={}>".format(self.name, self.exit_code)
+
+
+class Slots:
+    """Counting semaphore where a single acquire can take several slots"""
+    def __init__(self, size: int):
+        self.size = size
+        self._free = size
+        self._cond = threading.Condition()
+
+    def acquire(self, count: int) -> int:
+        """Block until ``count`` slots are free. Returns the number of slots taken"""
+        count = min(count, self.size)
+        with self._cond:
+            self._cond.wait_for(lambda: self._free >= count)
+            self._free -= count
+        return count
+
+    def release(self, count: int):
+        with self._cond:
+            self._free += count
+            self._cond.notify_all()
+
+
+def run(jobs: List[Job], concurrency: int = 1) -> List[JobResult]:
+    """
+    Run jobs using at most ``concurrency`` pool slots at the same time.
+
+    With a concurrency above 1 the log output of each job is buffered
+    and written in one block when the job completes so output from
+    parallel jobs is never interleaved.
+
+    Returns:
+        List of results in the same order as the jobs
+    """
+    if concurrency <= 1 or len(jobs) <= 1:
+        return [_execute(job) for job in jobs]
+
+    slots = Slots(concurrency)
+
+    def worker(job: Job) -> JobResult:
+        taken = slots.acquire(job.weight)
+        try:
+            with log.capture() as records:
+                result = _execute(job)
+            result.records = records
+            return result
+        finally:
+            slots.release(taken)
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=min(concurrency, len(jobs))) as executor:
+        futures = {executor.submit(worker, job): job for job in jobs}
+        for future in as_completed(futures):
+            result = future.result()
+            results[futures[future]] = result
+            logger.info('%s %s (exit code %s, %.1fs) %s',
+                        '-' * 10, result.name, result.exit_code, result.duration, '-' * 10)
+            log.replay(result.records)
+
+    return [results[job] for job in jobs]
+
+
+def _execute(job: Job) -> JobResult:
+    """Run a single job capturing exceptions as a non-zero exit code"""
+    start = time.monotonic()
+    summary = None
+    try:
+        exit_code = job.func()
+        if isinstance(exit_code, tuple):
+            exit_code, summary = exit_code
+    except Exception as ex:
+        logger.error('Exception raised in %s', job.name)
+        logger.exception(ex)
+        exit_code = 1
+
+    return JobResult(job.name, exit_code, time.monotonic() - start, summary=summary)
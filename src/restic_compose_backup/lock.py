@@ -0,0 +1,120 @@
+"""
+Coordination of restic operations between projects sharing a repository.
+
+Backups only take shared locks in the repository while forget, prune
+and check need an exclusive lock and fail if any other lock is present.
+Before running restic, processes take an ``flock`` on files in the lock
+directory keyed by the repository. Backups share the lock and exclusive
+operations wait in line for it. A queued exclusive operation holds back
+new backups so it is not starved by overlapping backup schedules.
+
+Only processes on the same host mounting the same lock directory
+are coordinated.
+"""
+import fcntl
+import hashlib
+import logging
+import os
+import time
+from contextlib import contextmanager
+
+from restic_compose_backup import metrics, restic, utils
+from restic_compose_backup.config import config
+
+logger = logging.getLogger(__name__)
+
+# Seconds between attempts to take a lock
+POLL_INTERVAL = 1
+
+
+def lock_path(repository: str, suffix: str = 'lock') -> str:
+    """str: Path of a lock file for the repository"""
+    digest = hashlib.sha256(repository.encode()).hexdigest()[:16]
+    return os.path.join(config.lock_dir, f'{digest}.{suffix}')
+
+
+@contextmanager
+def repository_lock(repository: str, operation: str, exclusive: bool = False):
+    """
+    Hold the lock of the repository while running ``operation``.
+    Stale restic locks are removed once the lock is taken.
+
+    Raises:
+        TimeoutError if the lock is not taken within ``LOCK_TIMEOUT`` seconds
+    """
+    mode = 'exclusive' if exclusive else 'shared'
+    try:
+        os.makedirs(config.lock_dir, exist_ok=True)
+        queue_fd = os.open(lock_path(repository, 'queue'), os.O_RDWR | os.O_CREAT, 0o666)
+    except OSError as ex:
+        logger.warning('Unable to use lock directory %s: %s', config.lock_dir, ex)
+        queue_fd = None
+
+    if queue_fd is None:
+        yield
+        return
+
+    lock_fd = None
+    try:
+        lock_fd = os.open(lock_path(repository), os.O_RDWR | os.O_CREAT, 0o666)
+        start = time.monotonic()
+        deadline = start + config.lock_timeout if config.lock_timeout > 0 else None
+
+        # Exclusive operations keep their place in the queue until they are done.
+        # Backups only pass through it so they wait for queued exclusive operations.
+        acquire(queue_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH, deadline, operation, mode)
+        acquire(lock_fd, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH, deadline, operation, mode)
+        if not exclusive:
+            fcntl.flock(queue_fd, fcntl.LOCK_UN)
+
+        waited = time.monotonic() - start
+        metrics.registry.set('lock_wait_seconds', waited, operation=operation, mode=mode)
+        if waited >= POLL_INTERVAL:
+            logger.info('Took %s repository lock for %s after %s', mode, operation, utils.format_duration(waited))
+
+        clear_stale_locks(repository)
+        yield
+    finally:
+        # Closing the files releases the locks
+        if lock_fd is not None:
+            os.close(lock_fd)
+        os.close(queue_fd)
+
+
+def acquire(fd: int, operation: int, deadline: float, name: str, mode: str):
+    """Take an flock polling until the deadline"""
+    logged = False
+    while True:
+        try:
+            fcntl.flock(fd, operation | fcntl.LOCK_NB)
+            return
+        except BlockingIOError:
+            pass
+
+        if deadline is not None and time.monotonic() >= deadline:
+            metrics.registry.set('lock_wait_seconds', config.lock_timeout, operation=name, mode=mode)
+            raise TimeoutError(f'Timed out waiting {utils.format_duration(config.lock_timeout)} '
+                               f'for the {mode} repository lock for {name}')
+
+        if not logged:
+            logger.info('Waiting for %s repository lock for %s', mode, name)
+            logged = True
+
+        time.sleep(POLL_INTERVAL)
+
+
+def clear_stale_locks(repository: str):
+    """
+    Remove locks left by crashed restic processes. ``restic unlock``
+    keeps locks of processes that are still running or refreshing them.
+    """
+    locks = restic.list_locks(repository)
+    if not locks:
+        return
+
+    logger.info('Found %s locks in the repository. Removing stale locks', len(locks))
+    restic.unlock(repository)
+
+    remaining = restic.list_locks(repository)
+    if remaining:
+        logger.info('%s locks held by running restic processes remain', len(remaining))
@@ -1,9 +1,12 @@
 import logging
 import os
 import sys
+import threading
+from contextlib import contextmanager
+from typing import List
 
 logger = logging.getLogger('restic_compose_backup')
-HOSTNAME = os.environ['HOSTNAME']
+HOSTNAME = os.environ.get('HOSTNAME')
 
 DEFAULT_LOG_LEVEL = logging.INFO
 LOG_LEVELS = {
@@ -25,4 +28,53 @@ def setup(level: str = 'warning'):
     # ch.setFormatter(logging.Formatter('%(asctime)s - {HOSTNAME} - %(name)s - %(levelname)s - %(message)s'))
     # ch.setFormatter(logging.Formatter('%(asctime)s - {HOSTNAME} - %(levelname)s - %(message)s'))
     ch.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s: %(message)s'))
+    ch.addFilter(CaptureFilter())
     logger.addHandler(ch)
+
+
+_capture = threading.local()
+
+
+class CaptureFilter(logging.Filter):
+    """Diverts records emitted by a thread inside ``capture()`` into its buffer"""
+
+    def filter(self, record):
+        records = getattr(_capture, 'records', None)
+        if records is None:
+            return True
+
+        records.append(record)
+        return False
+
+
+@contextmanager
+def capture():
+    """Buffer log records emitted by the current thread instead of writing them"""
+    records = []
+    with capture_into(records):
+        yield records
+
+
+def current_capture() -> List[logging.LogRecord]:
+    """list: The buffer records of the current thread go to or ``None`` if not captured"""
+    return getattr(_capture, 'records', None)
+
+
+@contextmanager
+def capture_into(records: List[logging.LogRecord]):
+    """
+    Buffer log records emitted by the current thread in ``records``.
+    Helper threads use this to log into the buffer of the thread starting them.
+    """
+    previous = getattr(_capture, 'records', None)
+    _capture.records = records
+    try:
+        yield records
+    finally:
+        _capture.records = previous
+
+
+def replay(records: List[logging.LogRecord]):
+    """Emit previously captured records in the current thread"""
+    for record in records:
+        logging.getLogger(record.name).handle(record)
@@ -0,0 +1,249 @@
+"""
+Prometheus metrics for every backup phase.
+
+Metrics are written atomically in the text exposition format
+so they can be picked up by the node exporter textfile collector
+or served by the ``rcb metrics-server`` command.
+"""
+import logging
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import List
+
+from restic_compose_backup.config import config
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'restic_compose_backup'
+METRICS = {
+    'phase_duration_seconds': ('gauge', 'Duration of the backup phase'),
+    'phase_exit_code': ('gauge', 'Exit code of the backup phase'),
+    'phase_bytes_processed': ('gauge', 'Bytes processed by restic in the backup phase'),
+    'phase_bytes_added': ('gauge', 'Bytes added to the repository in the backup phase'),
+    'phase_files_processed': ('gauge', 'Files processed by restic in the backup phase'),
+    'phase_timestamp_seconds': ('gauge', 'Unix time the backup phase completed'),
+    'phase_dump_bytes': ('gauge', 'Bytes relayed from the database dump to restic'),
+    'phase_dump_read_wait_seconds': ('gauge', 'Time restic waited for the database dump'),
+    'phase_dump_write_wait_seconds': ('gauge', 'Time the database dump waited for restic'),
+    'cache_size_bytes': ('gauge', 'Size of the restic cache'),
+    'volumes_skipped': ('gauge', 'Volume units skipped because their fingerprint did not change'),
+    'volumes_skipped_bytes': ('gauge', 'Size of the volume units skipped'),
+    'cache_hit_ratio': ('gauge', 'Estimated share of cache files reused in the run'),
+    'lock_wait_seconds': ('gauge', 'Time waited for the repository lock'),
+    'check_estimated_bytes': ('gauge', 'Estimated pack data read by the check (repository size / subsets)'),
+}
+
+
+class Phase:
+    """Values recorded for a single phase"""
+    def __init__(self, name: str, labels: dict):
+        self.name = name
+        self.labels = labels
+        self.exit_code = 0
+        self.duration = 0.0
+        self.summary = None
+
+
+class Registry:
+    """
+    Collects phase samples and writes them to the textfile.
+    Nothing is written until the registry is configured with the
+    project and the role of this process (backup, process, ..).
+    """
+
+    def __init__(self):
+        self.project = ''
+        self.role = None
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def configure(self, project: str = None, role: str = None):
+        self.project = project or ''
+        self.role = role
+        self.write()
+
+    @property
+    def path(self) -> Path:
+        """Path: The textfile for this process or ``None`` if metrics are disabled"""
+        if not config.metrics_dir or not self.role:
+            return None
+
+        name = '_'.join(part for part in [PREFIX, self.project, self.role] if part)
+        return Path(config.metrics_dir) / f'{name}.prom'
+
+    @contextmanager
+    def phase(self, name: str, **labels):
+        """
+        Time a phase. The exit code and restic summary can be set on
+        the yielded object. Exceptions are recorded as exit code 1.
+        """
+        phase = Phase(name, labels)
+        start = time.monotonic()
+        try:
+            yield phase
+        except BaseException:
+            phase.exit_code = 1
+            raise
+        finally:
+            phase.duration = time.monotonic() - start
+            self.record(phase)
+
+    def record_job(self, name: str, result, **labels):
+        """Record a finished ``jobs.JobResult`` as a phase"""
+        phase = Phase(name, labels)
+        phase.exit_code = result.exit_code
+        phase.duration = result.duration
+        phase.summary = result.summary
+        self.record(phase)
+
+    def record(self, phase: Phase):
+        key = tuple(sorted({'phase': phase.name, **phase.labels}.items()))
+        summary = phase.summary or {}
+        values = {
+            'phase_duration_seconds': phase.duration,
+            'phase_exit_code': phase.exit_code if isinstance(phase.exit_code, int) else 1,
+            'phase_timestamp_seconds': time.time(),
+        }
+        if 'total_bytes_processed' in summary:
+            values['phase_bytes_processed'] = summary['total_bytes_processed']
+        if 'data_added' in summary:
+            values['phase_bytes_added'] = summary['data_added']
+        if 'total_files_processed' in summary:
+            values['phase_files_processed'] = summary['total_files_processed']
+        if 'dump_bytes' in summary:
+            values['phase_dump_bytes'] = summary['dump_bytes']
+            values['phase_dump_read_wait_seconds'] = summary['dump_read_wait']
+            values['phase_dump_write_wait_seconds'] = summary['dump_write_wait']
+
+        with self._lock:
+            for metric, value in values.items():
+                self._samples[(metric, key)] = value
+
+        self.write()
+
+    def set(self, metric: str, value, **labels):
+        """Set a metric outside of a phase"""
+        with self._lock:
+            self._samples[(metric, tuple(sorted(labels.items())))] = value
+
+        self.write()
+
+    def render(self) -> str:
+        """str: All samples in the prometheus text format"""
+        lines = []
+        with self._lock:
+            samples = sorted(self._samples.items())
+
+        for metric, (metric_type, description) in METRICS.items():
+            entries = [(key, value) for (name, key), value in samples if name == metric]
+            if not entries:
+                continue
+
+            lines.append(f'# HELP {PREFIX}_{metric} {description}')
+            lines.append(f'# TYPE {PREFIX}_{metric} {metric_type}')
+            for key, value in entries:
+                # The role keeps series of phases run by several commands apart
+                common = (('project', self.project), ('role', self.role))
+                labels = ','.join('{}="{}"'.format(k, escape(v)) for k, v in common + key)
+                lines.append(f'{PREFIX}_{metric}{{{labels}}} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Atomically replace the textfile"""
+        path = self.path
+        if path is None:
+            return
+
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix='.', suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(self.render())
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, str(path))
+        except OSError as ex:
+            logger.error('Failed to write metrics to %s: %s', path, ex)
+
+
+def escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def merge(texts: List[str]) -> str:
+    """
+    Merge textfiles so every metric family is written once with its
+    ``# HELP`` and ``# TYPE`` lines followed by the samples of all files.
+    A series present in several files keeps the value of the last one.
+    """
+    families = {}
+
+    def family(name):
+        return families.setdefault(name, {'help': None, 'type': None, 'samples': {}})
+
+    for text in texts:
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+
+            if line.startswith('#'):
+                parts = line.split(None, 3)
+                if len(parts) >= 3 and parts[1] in ('HELP', 'TYPE'):
+                    family(parts[2])[parts[1].lower()] = line
+                continue
+
+            # The series is the name and labels, the value follows the closing brace or first space
+            end = line.rfind('}') + 1 if '{' in line else line.find(' ')
+            if end <= 0:
+                continue
+
+            series = line[:end]
+            family(series.split('{', 1)[0])['samples'][series] = line
+
+    lines = []
+    for values in families.values():
+        lines.extend(line for line in (values['help'], values['type']) if line)
+        lines.extend(values['samples'].values())
+
+    return '\n'.join(lines) + '\n' if lines else ''
+
+
+def serve(port: int, directory: str):
+    """Serve all textfiles in the metrics directory on ``/metrics``"""
+
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != '/metrics':
+                self.send_error(404)
+                return
+
+            texts = []
+            for path in sorted(Path(directory).glob('*.prom')):
+                try:
+                    texts.append(path.read_text())
+                except OSError as ex:
+                    logger.warning('Unable to read %s: %s', path, ex)
+
+            body = merge(texts).encode()
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            logger.debug(format, *args)
+
+    logger.info('Serving metrics from %s on port %s', directory, port)
+    ThreadingHTTPServer(('', port), Handler).serve_forever()
+
+
+registry = Registry()
+phase = registry.phase
+record_job = registry.record_job
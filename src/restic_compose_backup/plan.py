@@ -0,0 +1,130 @@
+"""
+Backup plan computed by the backup command and executed by the
+backup process container so it does not have to repeat discovery.
+"""
+import json
+import logging
+import os
+from typing import List, TYPE_CHECKING
+
+import docker
+
+from restic_compose_backup import enums, utils
+from restic_compose_backup.containers import Container
+
+if TYPE_CHECKING:
+    from restic_compose_backup.config import Config
+    from restic_compose_backup.containers import RunningContainers
+
+logger = logging.getLogger(__name__)
+
+
+class BackupPlan:
+    """What the backup process container should back up"""
+    version = 2
+
+    def __init__(self, project_name: str = '', mounts: dict = None,
+                 volumes: List[dict] = None, databases: List[dict] = None):
+        self.project_name = project_name
+        # Volume mounts for the backup process container
+        self.mounts = mounts or {}
+        # Paths inside the backup process container backed up in separate restic sessions and their tags
+        self.volumes = volumes or []
+        # Database units. Credentials are read from the referenced container at backup time
+        self.databases = databases or []
+
+    @classmethod
+    def build(cls, containers: 'RunningContainers', config: 'Config') -> 'BackupPlan':
+        """Create a plan from discovered containers"""
+        databases = []
+        for container in containers.containers_for_backup():
+            if not container.database_backup_enabled:
+                continue
+
+            instance = container.instance
+            databases.append({
+                'service': container.service_name,
+                'type': instance.container_type,
+                'destination': str(instance.backup_destination_path()),
+                'concurrency': container.concurrency,
+                'tags': instance.backup_tags(),
+                'credentials': {
+                    'container_id': container.id,
+                    'env': list(instance.credentials_env),
+                },
+            })
+
+        return cls(
+            project_name=containers.project_name,
+            mounts=containers.generate_backup_mounts('/volumes'),
+            volumes=containers.generate_backup_units('/volumes', config.volume_backup_split),
+            databases=databases,
+        )
+
+    @classmethod
+    def from_env(cls) -> 'BackupPlan':
+        """BackupPlan: The plan passed to this container or ``None``"""
+        value = os.environ.get(enums.ENV_BACKUP_PLAN)
+        if not value:
+            return None
+
+        return cls.from_json(value)
+
+    @classmethod
+    def from_json(cls, value: str) -> 'BackupPlan':
+        data = json.loads(value)
+        if data.get('version') != cls.version:
+            raise ValueError("Unsupported backup plan version: {}".format(data.get('version')))
+
+        return cls(
+            project_name=data.get('project_name', ''),
+            mounts=data.get('mounts'),
+            volumes=data.get('volumes'),
+            databases=data.get('databases'),
+        )
+
+    def to_json(self) -> str:
+        return json.dumps({
+            'version': self.version,
+            'project_name': self.project_name,
+            'mounts': self.mounts,
+            'volumes': self.volumes,
+            'databases': self.databases,
+        })
+
+    def to_env(self) -> str:
+        """str: The plan as a ``KEY=value`` environment entry"""
+        return f'{enums.ENV_BACKUP_PLAN}={self.to_json()}'
+
+    @property
+    def is_empty(self) -> bool:
+        """bool: Is there nothing to back up?"""
+        return not self.volumes and not self.databases
+
+    def database_container(self, unit: dict) -> Container:
+        """
+        Inspect the container of a database unit returning its service specific instance.
+        Raises ``RuntimeError`` if the container is gone or no longer running.
+        """
+        container_id = unit['credentials']['container_id']
+        try:
+            container = Container(utils.inspect_container(container_id))
+        except docker.errors.NotFound:
+            raise RuntimeError(f"Container {container_id[:12]} of service {unit['service']} no longer exists")
+
+        if not container.is_running:
+            raise RuntimeError(f"Container {container.name} of service {unit['service']} is not running")
+
+        return container.instance
+
+    @property
+    def units(self) -> List[dict]:
+        """List[dict]: All volume and database units"""
+        return self.volumes + self.databases
+
+    def log_summary(self):
+        logger.info("Backup plan for project '%s'", self.project_name)
+        for unit in self.volumes:
+            logger.info(' - volumes: %s', unit['path'])
+        for unit in self.databases:
+            logger.info(' - %s in service %s -> %s', unit['type'], unit['service'], unit['destination'])
@@ -1,10 +1,16 @@
 """
 Restic commands
 """
+import io
+import json
 import logging
+import os
+import threading
+import time
 from typing import List, Tuple
 from subprocess import Popen, PIPE
-from restic_compose_backup import commands
+from restic_compose_backup import commands, enums, utils
+from restic_compose_backup.config import config
 
 logger = logging.getLogger(__name__)
 
@@ -19,44 +25,248 @@ def init_repo(repository: str):
     ]))
 
 
-def backup_files(repository: str, source='/volumes'):
-    return commands.run(restic(repository, [
-        "--verbose",
+def backup_files(repository: str, source='/volumes', with_summary=False, tags: List[str] = None):
+    """
+    Back up a directory logging progress while restic is running.
+    The snapshot is recorded with ``tags``.
+    Returns the exit code or a tuple with the exit code
+    and the backup summary if ``with_summary`` is set.
+    """
+    progress = BackupProgress(source, interval=config.progress_interval)
+    exit_code = commands.run_stream(restic(repository, [
         "backup",
+        "--json",
+        *backup_options(repository, path=source, tags=tags),
         source,
-    ]))
+    ]), progress.feed, environment=progress_environment())
+    progress.log_summary()
+
+    if with_summary:
+        return exit_code, progress.summary
+
+    return exit_code
 
 
-def backup_from_stdin(repository: str, filename: str, source_command: List[str]):
+def backup_from_stdin(repository: str, filename: str, source_command: List[str],
+                      environment: dict = None, with_summary=False, tags: List[str] = None):
     """
     Backs up from stdin running the source_command passed in.
     It will appear in restic with the filename (including path) passed in.
+    Extra ``environment`` variables are only passed to the source command
+    so concurrent dumps never share credentials through ``os.environ``.
+    Returns the exit code or a tuple with the exit code and the
+    backup summary if ``with_summary`` is set.
     """
     dest_command = restic(repository, [
         'backup',
+        '--json',
+        *backup_options(repository, tags=tags),
         '--stdin',
         '--stdin-filename',
         filename,
     ])
+    progress = BackupProgress(filename, interval=config.progress_interval)
+
+    # Relay the source command into the dest command through enlarged pipes
+    # measuring the throughput and which side is waiting for the other
+    logger.debug('cmd: %s | %s', ' '.join(source_command), ' '.join(dest_command))
+    source_env = {**os.environ, **(environment or {})}
+    source_process = Popen(source_command, stdout=PIPE, stderr=PIPE, bufsize=0, env=source_env)
+    dest_process = Popen(dest_command, stdin=PIPE, stdout=PIPE, stderr=PIPE, bufsize=0,
+                         env={**os.environ, **progress_environment()})
 
-    # pipe source command into dest command
-    source_process = Popen(source_command, stdout=PIPE, bufsize=65536)
-    dest_process = Popen(dest_command, stdin=source_process.stdout, stdout=PIPE, stderr=PIPE, bufsize=65536)
-    stdout, stderr = dest_process.communicate()
+    chunk_size = config.pipe_size
+    for pipe in (source_process.stdout, dest_process.stdin):
+        chunk_size = min(chunk_size, commands.set_pipe_size(pipe.fileno(), config.pipe_size) or 65536)
+
+    relayed = []
+    relay_thread = threading.Thread(
+        target=lambda: relayed.append(commands.relay(source_process.stdout, dest_process.stdin, chunk_size)),
+        daemon=True,
+    )
+    relay_thread.start()
+    source_stderr_reader, source_stderr = commands.drain(source_process.stderr)
+    stderr_reader, stderr = commands.drain(dest_process.stderr)
+    # Only the relay needs unbuffered pipes. Status lines are read in blocks
+    for line in io.BufferedReader(dest_process.stdout):
+        progress.feed(line.decode(errors='replace'))
 
     # Ensure both processes exited with code 0
-    source_exit, dest_exit = source_process.poll(), dest_process.poll()
+    relay_thread.join()
+    relay_stats = relayed[0] if relayed else commands.RelayStats()
+    source_exit, dest_exit = source_process.wait(), dest_process.wait()
+    source_stderr_reader.join()
+    stderr_reader.join()
     exit_code = 0 if (source_exit == 0 and dest_exit == 0) else 1
 
-    if stdout:
-        commands.log_std('stdout', stdout, logging.DEBUG if exit_code == 0 else logging.ERROR)
-
+    if source_stderr:
+        commands.log_std(source_command[0], b''.join(source_stderr),
+                         logging.DEBUG if source_exit == 0 else logging.ERROR)
     if stderr:
-        commands.log_std('stderr', stderr, logging.ERROR)
+        commands.log_std('stderr', b''.join(stderr), logging.ERROR)
+
+    progress.log_summary()
+    log_relay(filename, relay_stats)
+
+    if with_summary:
+        summary = dict(progress.summary or {})
+        summary.update({
+            'dump_bytes': relay_stats.bytes,
+            'dump_read_wait': relay_stats.read_wait,
+            'dump_write_wait': relay_stats.write_wait,
+        })
+        return exit_code, summary
 
     return exit_code
 
 
+def log_relay(name: str, stats: 'commands.RelayStats'):
+    """Log dump throughput and whether the dump or restic was the bottleneck"""
+    logger.info(
+        '%s: dumped %s in %s, %.1f MB/s, waited %.1fs for the dump and %.1fs for restic (%s is the bottleneck)',
+        name,
+        utils.format_bytes(stats.bytes),
+        utils.format_duration(stats.duration),
+        stats.throughput / 1000 ** 2,
+        stats.read_wait,
+        stats.write_wait,
+        'dump' if stats.bottleneck == 'source' else 'restic',
+    )
+
+
+def progress_environment() -> dict:
+    """
+    Limit the status lines of ``restic backup --json`` to two per
+    ``PROGRESS_INTERVAL`` as only one progress line is logged per interval
+    """
+    return {'RESTIC_PROGRESS_FPS': str(2 / max(config.progress_interval, 1))}
+
+
+def backup_options(repository: str, path: str = None, tags: List[str] = None) -> List[str]:
+    """
+    The stable host and tags every backup is recorded with and the parent
+    snapshot of ``path`` if ``PARENT_SNAPSHOT_LOOKUP`` is enabled.
+    """
+    options = []
+    if config.restic_host:
+        options += ['--host', config.restic_host]
+
+    for tag in tags or []:
+        options += ['--tag', tag]
+
+    if path and utils.is_true(config.parent_snapshot_lookup):
+        parent = latest_snapshot(repository, path, host=config.restic_host)
+        if parent:
+            logger.debug('Parent snapshot for %s: %s', path, parent)
+            options += ['--parent', parent]
+        else:
+            logger.info('No parent snapshot found for %s', path)
+
+    return options
+
+
+class BackupProgress:
+    """Consumes ``restic backup --json`` output logging progress periodically"""
+
+    def __init__(self, name: str, interval: float = 60):
+        self.name = name
+        self.interval = interval
+        self.summary = {}
+        self._last_log = time.monotonic()
+
+    def feed(self, line: str):
+        """Handle a single line of restic output"""
+        line = line.strip()
+        if not line:
+            return
+
+        try:
+            message = json.loads(line)
+        except ValueError:
+            message = None
+
+        if not isinstance(message, dict):
+            logger.debug(line)
+            return
+
+        message_type = message.get('message_type')
+        if message_type == 'status':
+            now = time.monotonic()
+            if now - self._last_log >= self.interval:
+                self._last_log = now
+                logger.info('Progress %s: %s', self.name, format_progress(message))
+        elif message_type == 'summary':
+            self.summary = message
+        elif message_type == 'error':
+            logger.error('Error in %s during %s of %s: %s',
+                         self.name, message.get('during'), message.get('item'), message.get('error'))
+        else:
+            logger.debug(line)
+
+    def log_summary(self):
+        if self.summary:
+            logger.info('Summary %s: %s', self.name, format_summary(self.summary))
+
+
+def format_progress(status: dict) -> str:
+    """Single line description of a restic status message with throughput and ETA"""
+    elapsed = status.get('seconds_elapsed') or 0
+    bytes_done = status.get('bytes_done') or 0
+    total_bytes = status.get('total_bytes') or 0
+    files_done = status.get('files_done') or 0
+    total_files = status.get('total_files') or 0
+
+    parts = []
+    if total_bytes:
+        parts.append('{:.1f}%'.format((status.get('percent_done') or 0) * 100))
+        parts.append('{} / {}'.format(utils.format_bytes(bytes_done), utils.format_bytes(total_bytes)))
+    else:
+        parts.append(utils.format_bytes(bytes_done))
+
+    parts.append('{} / {} files'.format(files_done, total_files) if total_files else '{} files'.format(files_done))
+
+    if elapsed:
+        parts.append('{:.1f} files/s'.format(files_done / elapsed))
+        parts.append('{:.1f} MB/s'.format(bytes_done / elapsed / 1000 ** 2))
+
+    if status.get('seconds_remaining'):
+        parts.append('ETA {}'.format(utils.format_duration(status['seconds_remaining'])))
+
+    return ', '.join(parts)
+
+
+def format_summary(summary: dict) -> str:
+    """Single line description of a backup summary"""
+    if not summary:
+        return 'no summary'
+
+    return (
+        "files {} new / {} changed / {} unmodified, added {}, processed {} in {}, snapshot {}"
+    ).format(
+        summary.get('files_new', '?'),
+        summary.get('files_changed', '?'),
+        summary.get('files_unmodified', '?'),
+        utils.format_bytes(summary.get('data_added', 0)),
+        utils.format_bytes(summary.get('total_bytes_processed', 0)),
+        utils.format_duration(summary.get('total_duration', 0)),
+        (summary.get('snapshot_id') or '?')[:8],
+    )
+
+
+def restore(repository: str, snapshot: str, path: str):
+    """Restore ``path`` from a snapshot to its original location"""
+    return commands.run(restic(repository, [
+        "restore",
+        snapshot,
+        "--path",
+        path,
+        "--include",
+        path,
+        "--target",
+        "/",
+    ]))
+
+
 def snapshots(repository: str, last=True) -> Tuple[str, str]:
     """Returns the stdout and stderr info"""
     args = ["snapshots"]
@@ -65,6 +275,28 @@ def snapshots(repository: str, last=True) -> Tuple[str, str]:
     return commands.run_capture_std(restic(repository, args))
 
 
+def latest_snapshot(repository: str, path: str, host: str = None) -> str:
+    """str: The id of the latest snapshot of ``path`` or ``None``"""
+    args = ["snapshots", "--json", "--last", "--path", path]
+    if host:
+        args += ["--host", host]
+
+    exit_code, stdout = commands.run_output(restic(repository, args))
+    if exit_code != 0:
+        return None
+
+    try:
+        snapshots = json.loads(stdout or '[]') or []
+    except ValueError:
+        logger.warning('Unable to parse snapshots output')
+        return None
+
+    if not snapshots:
+        return None
+
+    return max(snapshots, key=lambda snapshot: snapshot['time'])['id']
+
+
 def is_initialized(repository: str) -> bool:
     """
     Checks if a repository is initialized using snapshots command.
@@ -75,11 +307,25 @@ def is_initialized(repository: str) -> bool:
     return commands.run(restic(repository, ["snapshots", '--last'])) == 0
 
 
-def forget(repository: str, daily: str, weekly: str, monthly: str, yearly: str):
-    return commands.run(restic(repository, [
+def forget(repository: str, daily: str, weekly: str, monthly: str, yearly: str,
+           tags: List[str] = None, host: str = None, untagged: bool = False) -> Tuple[int, int]:
+    """
+    Forget snapshots outside the keep policy. With ``tags`` only the
+    snapshots of that backup unit are considered (see ``unit_filter``),
+    with ``host`` only the snapshots of that host and with ``untagged``
+    only snapshots without tags grouped by their paths.
+
+    Returns:
+        Tuple with the exit code and the number of removed snapshots
+    """
+    exit_code, stdout = commands.run_output(restic(repository, [
         'forget',
+        '--json',
+        *(['--tag', unit_filter(tags)] if tags else []),
+        *(['--tag', ''] if untagged else []),
+        *(['--host', host] if host else []),
         '--group-by',
-        'paths',
+        'host,paths' if tags or host else 'paths',
         '--keep-daily',
         daily,
         '--keep-weekly',
@@ -90,6 +336,22 @@ def forget(repository: str, daily: str, weekly: str, monthly: str, yearly: str):
         yearly,
     ]))
 
+    kept, removed = 0, 0
+    try:
+        for group in json.loads(stdout or '[]') or []:
+            kept += len(group.get('keep') or [])
+            removed += len(group.get('remove') or [])
+    except ValueError:
+        logger.warning('Unable to parse forget output')
+
+    logger.info('Forget kept %s and removed %s snapshots', kept, removed)
+    return exit_code, removed
+
+
+def unit_filter(tags: List[str]) -> str:
+    """str: ``--tag`` value matching all snapshots of a backup unit regardless of the image"""
+    return ','.join(tag for tag in tags if not tag.startswith(f'{enums.TAG_IMAGE}='))
+
 
 def prune(repository: str):
     return commands.run(restic(repository, [
@@ -97,10 +359,54 @@ def prune(repository: str):
     ]))
 
 
-def check(repository: str):
+def check(repository: str, read_data_subset: str = None):
+    """Check the repository structure and optionally read a subset (``n/N``) of the pack data"""
+    args = ["check"]
+    if read_data_subset:
+        args.append(f"--read-data-subset={read_data_subset}")
+
+    return commands.run(restic(repository, args))
+
+
+def stats(repository: str, mode: str = 'raw-data') -> dict:
+    """dict: Repository statistics or ``None`` if they could not be read"""
+    exit_code, stdout = commands.run_output(restic(repository, [
+        "stats",
+        "--json",
+        "--mode",
+        mode,
+    ]))
+    if exit_code != 0:
+        return None
+
+    try:
+        return json.loads(stdout)
+    except ValueError:
+        logger.warning('Unable to parse stats output')
+        return None
+
+
+def cache_cleanup(repository: str):
+    """Remove cache directories of repositories not used for a while"""
+    return commands.run(restic(repository, [
+        "cache",
+        "--cleanup",
+    ]))
+
+
+def list_locks(repository: str) -> List[str]:
+    """list: Ids of the locks in the repository or ``None`` if they could not be listed"""
+    exit_code, stdout = commands.run_output(restic(repository, ["list", "locks", "--no-lock"]))
+    if exit_code != 0:
+        return None
+
+    return [line.strip() for line in stdout.splitlines() if line.strip()]
+
+
+def unlock(repository: str):
+    """Remove stale locks. Locks of running restic processes are kept"""
     return commands.run(restic(repository, [
-        "check",
-        # "--with-cache",
+        "unlock",
     ]))
 
 
@@ -110,4 +416,6 @@ def restic(repository: str, args: List[str]):
         "restic",
         "-r",
         repository,
+        "--cache-dir",
+        config.cache_dir,
     ] + args
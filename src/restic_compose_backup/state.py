@@ -0,0 +1,48 @@
+"""
+Small json documents persisted between runs in the state directory
+"""
+import json
+import logging
+import os
+import tempfile
+from pathlib import Path
+
+from restic_compose_backup.config import config
+
+logger = logging.getLogger(__name__)
+
+
+class State(dict):
+    """A json document in the state directory or the given directory"""
+
+    def __init__(self, name: str, directory: str = None):
+        super().__init__()
+        self.name = name
+        self.directory = directory
+        self.load()
+
+    @property
+    def path(self) -> Path:
+        return Path(self.directory or config.state_dir) / f'{self.name}.json'
+
+    def load(self):
+        """Read the document. A missing or broken file is an empty state"""
+        try:
+            with open(str(self.path)) as fd:
+                self.update(json.load(fd))
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as ex:
+            logger.warning('Ignoring unreadable state file %s: %s', self.path, ex)
+
+    def save(self):
+        """Atomically replace the document"""
+        path = self.path
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            fd, tmp = tempfile.mkstemp(dir=str(path.parent), prefix='.', suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self, f, indent=2, sort_keys=True)
+            os.replace(tmp, str(path))
+        except OSError as ex:
+            logger.error('Failed to write state to %s: %s', path, ex)
@@ -0,0 +1,187 @@
+"""
+Backups across all nodes in a swarm.
+
+The coordinator runs on a manager node. It finds the nodes running
+tasks of services with backup labels and starts a one-shot agent
+service pinned to each of them. The agent runs the regular backup
+command against the docker daemon of its own node.
+
+Host paths of the coordinator may not exist on other nodes. Agents
+only get the named volumes of the coordinator (created on their node
+if missing) and the docker socket.
+"""
+import logging
+import time
+from collections import deque
+from typing import List
+
+import docker
+
+from restic_compose_backup import backup_runner, enums, utils
+from restic_compose_backup.config import config
+from restic_compose_backup.containers import VOLUME_TYPE_BIND, VOLUME_TYPE_VOLUME, Mount
+
+logger = logging.getLogger(__name__)
+
+# Labels enabling backup of a service
+BACKUP_LABELS = [
+    enums.LABEL_VOLUMES_ENABLED,
+    enums.LABEL_MYSQL_ENABLED,
+    enums.LABEL_MARIADB_ENABLED,
+    enums.LABEL_POSTGRES_ENABLED,
+]
+# Task states a task never leaves
+TERMINAL_STATES = ['complete', 'failed', 'shutdown', 'rejected', 'orphaned', 'remove']
+# Seconds between polling the state of agent tasks
+POLL_INTERVAL = 5
+# The only host path forwarded to the agents
+DOCKER_SOCKET = '/var/run/docker.sock'
+
+
+class Node:
+    """A swarm node running tasks of services configured for backup"""
+    def __init__(self, node_id: str, hostname: str):
+        self.id = node_id
+        self.hostname = hostname
+        self.services = set()
+        # Networks of the services so the agent can reach the databases
+        self.networks = set()
+
+    def __repr__(self):
+        return str(self)
+
+    def __str__(self):
+        return "<Node {} services={}>".format(self.hostname, sorted(self.services))
+
+
+def find_nodes() -> List[Node]:
+    """Find the nodes running tasks of services with backup labels"""
+    client = utils.docker_client()
+    hostnames = {node.id: node.attrs['Description']['Hostname'] for node in utils.get_swarm_nodes()}
+
+    nodes = {}
+    for service in client.services.list():
+        spec = service.attrs['Spec']
+        task_template = spec.get('TaskTemplate') or {}
+        # Only the container labels are visible to the agent
+        labels = (task_template.get('ContainerSpec') or {}).get('Labels') or {}
+        if not any(utils.is_true(labels.get(label)) for label in BACKUP_LABELS):
+            continue
+
+        networks = [network['Target'] for network in task_template.get('Networks') or []]
+        for task in service.tasks(filters={'desired-state': 'running'}):
+            node_id = task.get('NodeID')
+            if not node_id or task['Status']['State'] != 'running':
+                continue
+
+            node = nodes.setdefault(node_id, Node(node_id, hostnames.get(node_id, node_id)))
+            node.services.add(spec['Name'])
+            node.networks.update(networks)
+
+    return sorted(nodes.values(), key=lambda node: node.hostname)
+
+
+def list_agents() -> list:
+    """list: Agent services left in the swarm"""
+    return utils.docker_client().services.list(filters={'label': enums.LABEL_SWARM_AGENT})
+
+
+def agent_running(service) -> bool:
+    """bool: Does the agent service have a task that has not finished?"""
+    return any(task['Status']['State'] not in TERMINAL_STATES for task in service.tasks())
+
+
+def agent_mounts(mounts: List[Mount]) -> List[docker.types.Mount]:
+    """Named volumes by name and the docker socket of the coordinator mounts"""
+    result = []
+    for mount in mounts:
+        if mount.type == VOLUME_TYPE_VOLUME:
+            result.append(docker.types.Mount(mount.destination, mount.name, type=VOLUME_TYPE_VOLUME))
+        elif mount.type == VOLUME_TYPE_BIND and mount.source == DOCKER_SOCKET:
+            result.append(docker.types.Mount(mount.destination, mount.source, type=VOLUME_TYPE_BIND))
+        else:
+            logger.info('Not forwarding mount %s to backup agents', mount.source)
+
+    return result
+
+
+def run_agent(node: Node, image: str, environment: List[str], mounts: List[Mount]) -> int:
+    """
+    Run the backup command without forget in a one-shot service
+    pinned to the node relaying its output when it completes.
+
+    Returns:
+        The exit code of the agent
+    """
+    client = utils.docker_client()
+
+    # Every node records its own host in the snapshots unless configured
+    environment = [env for env in environment if not env.startswith('HOSTNAME=')]
+    if not config.restic_host:
+        environment.append(f'RESTIC_HOST={node.hostname}')
+
+    logger.info('Starting backup agent on node %s for services %s', node.hostname, ', '.join(sorted(node.services)))
+    service = client.services.create(
+        image,
+        # Forget needs an exclusive lock in the repository. The coordinator runs it
+        # once all agents are done so it does not fail while other nodes back up
+        command=['rcb', 'backup', '--no-forget'],
+        name='rcb-agent-{}-{}'.format(node.id[:12], int(time.time())),
+        env=environment,
+        mounts=agent_mounts(mounts),
+        constraints=[f'node.id=={node.id}'],
+        restart_policy=docker.types.RestartPolicy(condition='none'),
+        networks=sorted(node.networks),
+        labels={enums.LABEL_SWARM_AGENT: node.hostname},
+        container_labels={enums.LABEL_SWARM_AGENT: node.hostname},
+    )
+
+    try:
+        exit_code = wait(service, config.swarm_agent_timeout)
+    except TimeoutError as ex:
+        logger.error(ex)
+        return 1
+    except Exception:
+        service.remove()
+        raise
+
+    try:
+        # Only the tail is kept in memory like the output of the backup process container
+        tail = deque(maxlen=config.backup_log_tail)
+        for line in backup_runner.readlines(service.logs(stdout=True, stderr=True)):
+            tail.append(line)
+        for line in tail:
+            logger.info(line)
+    finally:
+        service.remove()
+
+    logger.debug('Agent on node %s exit code: %s', node.hostname, exit_code)
+    return exit_code
+
+
+def wait(service, timeout: int) -> int:
+    """
+    Wait for the task of a one-shot service to finish returning its exit code.
+
+    Raises:
+        TimeoutError after removing the service if it did not finish within ``timeout`` seconds
+    """
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        for task in service.tasks():
+            status = task['Status']
+            if status['State'] not in TERMINAL_STATES:
+                continue
+
+            exit_code = (status.get('ContainerStatus') or {}).get('ExitCode')
+            if status['State'] == 'complete':
+                return exit_code or 0
+
+            logger.error("Agent task %s: %s", status['State'], status.get('Err') or status.get('Message'))
+            return exit_code or 1
+
+        time.sleep(POLL_INTERVAL)
+
+    # Removing the service stops the agent
+    service.remove()
+    raise TimeoutError(f'Agent did not finish within {utils.format_duration(timeout)}')
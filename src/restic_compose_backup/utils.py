@@ -1,9 +1,14 @@
+import atexit
 import os
 import logging
+import threading
 from typing import List, TYPE_CHECKING
 from contextlib import contextmanager
 import docker
 
+from restic_compose_backup import enums
+from restic_compose_backup.config import Config
+
 if TYPE_CHECKING:
     from restic_compose_backup.containers import Container
 
@@ -11,33 +16,116 @@ logger = logging.getLogger(__name__)
 
 TRUE_VALUES = ['1', 'true', 'True', True, 1]
 
+_docker_client = None
+_docker_client_lock = threading.Lock()
+
 
 def docker_client():
     """
-    Create a docker client from the following environment variables::
+    Get the docker client shared by the entire process.
+    It's created on first use from the following environment variables::
 
         DOCKER_HOST=unix://tmp/docker.sock
         DOCKER_TLS_VERIFY=1
         DOCKER_CERT_PATH=''
+
+    The client keeps a pool of connections to the docker api
+    and is closed when the process exits.
     """
-    # NOTE: Remove this fallback in 1.0
-    if not os.environ.get('DOCKER_HOST'):
-        os.environ['DOCKER_HOST'] = 'unix://tmp/docker.sock'
+    global _docker_client
+    with _docker_client_lock:
+        if _docker_client is None:
+            # NOTE: Remove this fallback in 1.0
+            if not os.environ.get('DOCKER_HOST'):
+                os.environ['DOCKER_HOST'] = 'unix://tmp/docker.sock'
+
+            config = Config(check=False)
+            _docker_client = docker.from_env(
+                timeout=config.docker_timeout,
+                max_pool_size=config.docker_pool_size,
+            )
+            atexit.register(close_docker_client)
 
-    return docker.from_env()
+        return _docker_client
 
 
-def list_containers() -> List[dict]:
+def close_docker_client():
+    """Close the shared docker client and its connections"""
+    global _docker_client
+    with _docker_client_lock:
+        if _docker_client is not None:
+            _docker_client.close()
+            _docker_client = None
+
+
+def list_containers(hostname: str = None, swarm_mode: bool = False) -> List[dict]:
     """
-    List all containers.
+    List containers.
+
+    Without a hostname all containers on the host are listed and inspected.
+    With a hostname the docker api filters the listing by status and
+    compose project and only containers with ``restic-compose-backup.*``
+    labels are inspected. The container matching the hostname is always
+    the first entry.
 
     Returns:
         List of raw container json data from the api
     """
     client = docker_client()
-    all_containers = client.containers.list(all=True)
-    client.close()
-    return [c.attrs for c in all_containers]
+    if not hostname:
+        all_containers = client.containers.list(all=True)
+        return [c.attrs for c in all_containers]
+
+    from restic_compose_backup.containers import Container
+    api = client.api
+
+    try:
+        this_container = api.inspect_container(hostname)
+    except docker.errors.NotFound:
+        logger.error("Cannot find container with hostname '%s'", hostname)
+        return []
+
+    calls = 1
+    this = Container(this_container)
+    running_filters = {'status': 'running'}
+    if not swarm_mode and this.project_name:
+        running_filters['label'] = f'com.docker.compose.project={this.project_name}'
+
+    candidates = api.containers(filters=running_filters)
+    # Stale backup process containers from earlier runs
+    candidates += api.containers(all=True, filters={
+        'status': ['created', 'exited', 'dead'],
+        'label': this.backup_process_label,
+    })
+    calls += 2
+
+    result = [this_container]
+    seen = {this_container['Id']}
+    for candidate in candidates:
+        if candidate['Id'] in seen:
+            continue
+        seen.add(candidate['Id'])
+
+        labels = candidate.get('Labels') or {}
+        if not any(name.startswith(enums.LABEL_PREFIX) for name in labels):
+            continue
+
+        result.append(api.inspect_container(candidate['Id']))
+        calls += 1
+
+    logger.info("Container discovery: %s candidates, %s inspected, %s docker api calls",
+                len(seen), len(result), calls)
+    return result
+
+
+def inspect_container(container_id: str) -> dict:
+    """dict: Raw container json data from the api"""
+    return docker_client().api.inspect_container(container_id)
+
+
+def ping():
+    """Check that the docker api is available. Raises an exception if not"""
+    docker_client().ping()
 
 
 def get_swarm_nodes():
@@ -71,6 +159,32 @@ def is_true(value):
     return value in TRUE_VALUES
 
 
+def format_bytes(value) -> str:
+    """Human readable size using binary units"""
+    value = float(value or 0)
+    for unit in ['B', 'KiB', 'MiB', 'GiB', 'TiB']:
+        if abs(value) < 1024 or unit == 'TiB':
+            break
+        value /= 1024
+
+    return '{:.1f} {}'.format(value, unit) if unit != 'B' else '{:.0f} B'.format(value)
+
+
+def format_duration(seconds) -> str:
+    """Duration as h:mm:ss"""
+    seconds = int(seconds or 0)
+    return '{}:{:02d}:{:02d}'.format(seconds // 3600, seconds % 3600 // 60, seconds % 60)
+
+
+def is_on_root_filesystem(path) -> bool:
+    """bool: Is the path (or its nearest existing parent) on the filesystem of ``/``?"""
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+
+    return os.stat(path).st_dev == os.stat('/').st_dev
+
+
 def strip_root(path):
     """
     Removes the root slash in a path.
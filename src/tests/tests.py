@@ -1,4 +1,5 @@
 import json
+import logging
 import os
 import unittest
 from unittest import mock
@@ -201,3 +202,936 @@ class ResticBackupTests(unittest.TestCase):
         with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
             cnt = RunningContainers()
             self.assertTrue(cnt.backup_process_running)
+
+    def test_jobs_concurrent(self):
+        """Jobs overlap within the pool slots and results keep the job order"""
+        import threading
+        import time
+        from restic_compose_backup import jobs
+
+        concurrency = 3
+        lock = threading.Lock()
+        running = {'jobs': 0, 'weight': 0}
+        peak = {'jobs': 0, 'weight': 0}
+
+        def job(exit_code, weight=1):
+            # Jobs heavier than the pool take all of its slots
+            weight = min(weight, concurrency)
+
+            def func():
+                with lock:
+                    running['jobs'] += 1
+                    running['weight'] += weight
+                    peak['jobs'] = max(peak['jobs'], running['jobs'])
+                    peak['weight'] = max(peak['weight'], running['weight'])
+                try:
+                    time.sleep(0.05)
+                    if exit_code is None:
+                        raise ValueError("Broken job")
+                    return exit_code
+                finally:
+                    with lock:
+                        running['jobs'] -= 1
+                        running['weight'] -= weight
+            return jobs.Job(str(exit_code), func, weight=weight)
+
+        results = jobs.run([
+            job(0),
+            job(1, weight=10),
+            job(None),
+            job(0, weight=2),
+            job(0),
+            job(0),
+        ], concurrency=concurrency)
+        self.assertEqual([r.name for r in results], ['0', '1', 'None', '0', '0', '0'])
+        self.assertEqual([r.exit_code for r in results], [0, 1, 1, 0, 0, 0])
+        self.assertGreater(peak['jobs'], 1)
+        self.assertLessEqual(peak['weight'], concurrency)
+
+    def test_generate_backup_units(self):
+        containers = self.createContainers()
+        containers += [
+            {
+                'service': 'web',
+                'labels': {
+                    'restic-compose-backup.volumes': True,
+                },
+                'mounts': [
+                    {
+                        'Source': '/srv/files/media',
+                        'Destination': '/srv/media',
+                        'Type': 'bind',
+                    },
+                    {
+                        'Source': '/srv/files/stuff',
+                        'Destination': '/srv/stuff',
+                        'Type': 'bind',
+                    },
+                ]
+            },
+        ]
+        with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
+            cnt = RunningContainers()
+
+        tags = ['project=default', 'service=web', 'type=volume', 'image=restic-compose-backup_backup']
+        self.assertEqual(cnt.generate_backup_units(), [
+            {'path': '/volumes', 'tags': ['project=default', 'type=volume']},
+        ])
+        self.assertEqual(cnt.generate_backup_units(split='service'), [{'path': '/volumes/web', 'tags': tags}])
+        self.assertEqual(
+            [unit['path'] for unit in cnt.generate_backup_units(split='volume')],
+            ['/volumes/web/srv/media', '/volumes/web/srv/stuff'],
+        )
+
+    def test_list_containers_filtered(self):
+        """Only labeled containers are inspected when discovering by hostname"""
+        data = fixtures.containers(containers=[
+            {'id': 'backup' + fixtures.generate_sha256(), 'service': 'backup'},
+            {'id': 'web', 'service': 'web', 'labels': {'restic-compose-backup.volumes': True}},
+            {'id': 'redis', 'service': 'redis'},
+        ])()
+        by_id = {c['Id']: c for c in data}
+        client = mock.MagicMock()
+        client.api.inspect_container.side_effect = lambda cid: by_id[cid] if cid in by_id else next(
+            c for c in data if c['Id'].startswith(cid))
+        client.api.containers.side_effect = [
+            [{'Id': c['Id'], 'Labels': c['Config']['Labels']} for c in data],
+            [],
+        ]
+
+        with mock.patch('restic_compose_backup.utils.docker_client', return_value=client), \
+                self.assertLogs('restic_compose_backup.utils', level='INFO') as logs:
+            result = utils.list_containers(hostname='backup')
+
+        self.assertEqual([c['Id'] for c in result], [data[0]['Id'], 'web'])
+        self.assertEqual(client.api.inspect_container.call_count, 2)
+        self.assertIn('3 candidates, 2 inspected, 4 docker api calls', logs.output[-1])
+        filters = client.api.containers.call_args_list[0][1]['filters']
+        self.assertEqual(filters['label'], 'com.docker.compose.project=default')
+
+    def test_container_indexes(self):
+        containers = self.createContainers()
+        containers += [
+            {
+                'id': 'mariadb-id',
+                'service': 'mariadb',
+                'labels': {
+                    'restic-compose-backup.mariadb': True,
+                },
+            },
+            {
+                'service': 'redis',
+            },
+        ]
+        with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
+            cnt = RunningContainers()
+
+        mariadb = cnt.get_container('mariadb-id')
+        self.assertIs(cnt.get_service('mariadb'), mariadb)
+        self.assertEqual(cnt.containers_for_backup(), [mariadb])
+        self.assertEqual(len(cnt.get_project('default')), 3)
+        self.assertIs(mariadb.instance, mariadb.instance)
+        self.assertEqual(mariadb.instance.container_type, 'mariadb')
+        self.assertFalse(hasattr(mariadb, '__dict__'))
+
+    def test_backup_plan(self):
+        from restic_compose_backup.config import Config
+        from restic_compose_backup.plan import BackupPlan
+
+        containers = self.createContainers()
+        containers += [
+            {
+                'service': 'web',
+                'labels': {
+                    'restic-compose-backup.volumes': True,
+                },
+                'mounts': [{
+                    'Source': 'test',
+                    'Destination': 'test',
+                    'Type': 'bind',
+                }]
+            },
+            {
+                'id': 'mysql-id',
+                'service': 'mysql',
+                'labels': {
+                    'restic-compose-backup.mysql': True,
+                },
+            },
+        ]
+        with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
+            cnt = RunningContainers()
+
+        plan = BackupPlan.build(cnt, Config())
+        self.assertFalse(plan.is_empty)
+
+        plan = BackupPlan.from_json(plan.to_json())
+        self.assertEqual([unit['path'] for unit in plan.volumes], ['/volumes/web'])
+        self.assertEqual(plan.mounts, {'test': {'bind': '/volumes/web/test', 'mode': 'ro'}})
+        self.assertEqual(len(plan.databases), 1)
+        self.assertEqual(plan.databases[0]['destination'], '/databases/mysql/all_databases.sql')
+        self.assertEqual(plan.databases[0]['credentials']['container_id'], 'mysql-id')
+        self.assertIn('type=mysql', plan.databases[0]['tags'])
+        self.assertTrue(BackupPlan('default').is_empty)
+
+        # A database container gone or stopped since planning only fails its own unit
+        import docker
+        from restic_compose_backup import cli
+
+        unit = plan.databases[0]
+        data = fixtures.containers(containers=containers)()[2]
+        with mock.patch('restic_compose_backup.utils.inspect_container', return_value=data):
+            self.assertEqual(plan.database_container(unit).container_type, 'mysql')
+
+        data['State'] = {'Status': 'exited', 'Running': False}
+        with mock.patch('restic_compose_backup.utils.inspect_container', return_value=data), \
+                self.assertLogs('restic_compose_backup.cli', level='ERROR'):
+            self.assertEqual(cli.backup_database(plan, unit), 1)
+
+        with mock.patch('restic_compose_backup.utils.inspect_container', side_effect=docker.errors.NotFound('gone')), \
+                self.assertLogs('restic_compose_backup.cli', level='ERROR') as logs:
+            self.assertEqual(cli.backup_database(plan, unit), 1)
+        self.assertIn('no longer exists', logs.output[0])
+
+    def test_split_databases(self):
+        containers = self.createContainers()
+        containers += [
+            {
+                'service': 'mariadb',
+                'labels': {
+                    'restic-compose-backup.mariadb': True,
+                    'restic-compose-backup.databases.split': True,
+                    'restic-compose-backup.databases.exclude': 'test_*, scratch',
+                },
+            },
+        ]
+        with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
+            cnt = RunningContainers()
+
+        instance = cnt.get_service('mariadb').instance
+        databases = ['information_schema', 'mysql', 'shop', 'test_shop', 'scratch', 'sys']
+        with mock.patch('restic_compose_backup.commands.list_mysql_databases', return_value=(0, databases)):
+            self.assertEqual(instance.databases_for_backup(), ['mysql', 'shop'])
+
+        self.assertEqual(str(instance.backup_destination_path('shop')), '/databases/mariadb/shop.sql')
+        self.assertIn('shop', instance.dump_command('shop'))
+        self.assertNotIn('--all-databases', instance.dump_command('shop'))
+
+    def test_postgres_directory_format(self):
+        containers = self.createContainers()
+        containers += [
+            {
+                'service': 'postgres',
+                'labels': {
+                    'restic-compose-backup.postgres': True,
+                    'restic-compose-backup.postgres.directory': True,
+                    'restic-compose-backup.concurrency': '4',
+                },
+            },
+        ]
+        with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
+            cnt = RunningContainers()
+
+        instance = cnt.get_service('postgres').instance
+        with mock.patch.object(type(instance), 'get_credentials', return_value={
+                'host': 'pg', 'port': '5432', 'username': 'user', 'password': 'pw', 'database': 'app'}):
+            path = instance.backup_destination_path()
+            self.assertEqual(str(path), '/databases/postgres/app')
+            self.assertIn('--jobs=4', instance.dump_directory_command(path))
+            self.assertIn('--format=directory', instance.dump_directory_command(path))
+            self.assertIn('--compress=0', instance.dump_directory_command(path))
+            self.assertIn('--jobs=4', instance.restore_directory_command(path))
+
+        self.assertEqual(instance.concurrency, 4)
+
+        # A missing label runs a single job and invalid values are logged
+        containers[-1]['labels']['restic-compose-backup.concurrency'] = 'four'
+        with mock.patch(list_containers_func, fixtures.containers(containers=containers)), \
+                self.assertLogs('restic_compose_backup.containers', level='WARNING') as logs:
+            cnt = RunningContainers()
+        self.assertEqual(cnt.get_service('postgres').concurrency, 1)
+        self.assertIn("Invalid value 'four'", logs.output[0])
+
+        del containers[-1]['labels']['restic-compose-backup.concurrency']
+        with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
+            cnt = RunningContainers()
+        self.assertEqual(cnt.get_service('postgres').concurrency, 1)
+
+        # Missing directories are resolved to their nearest existing parent
+        self.assertTrue(utils.is_on_root_filesystem('/nonexistent/databases'))
+
+    def test_dump_profile(self):
+        containers = self.createContainers()
+        containers += [
+            {
+                'service': 'mysql',
+                'labels': {
+                    'restic-compose-backup.mysql': True,
+                    'restic-compose-backup.dump.profile': 'dedup',
+                },
+            },
+            {
+                'service': 'mariadb',
+                'labels': {
+                    'restic-compose-backup.mariadb': True,
+                },
+            },
+        ]
+        with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
+            cnt = RunningContainers()
+
+        self.assertIn('--skip-extended-insert', cnt.get_service('mysql').instance.dump_command())
+        self.assertNotIn('--skip-extended-insert', cnt.get_service('mariadb').instance.dump_command())
+
+    def test_backup_progress(self):
+        from restic_compose_backup import restic
+
+        progress = restic.BackupProgress('/volumes', interval=0)
+        with self.assertLogs('restic_compose_backup.restic', level='INFO') as logs:
+            progress.feed('open repository\n')
+            progress.feed(json.dumps({
+                'message_type': 'status', 'seconds_elapsed': 10, 'seconds_remaining': 20,
+                'percent_done': 0.25, 'total_files': 400, 'files_done': 100,
+                'total_bytes': 4 * 1024 ** 3, 'bytes_done': 1024 ** 3,
+            }))
+            progress.feed(json.dumps({
+                'message_type': 'summary', 'files_new': 1, 'files_changed': 2, 'files_unmodified': 3,
+                'data_added': 1024, 'total_bytes_processed': 2048, 'total_duration': 65.2,
+                'snapshot_id': 'a1b2c3d4e5f6',
+            }))
+            progress.log_summary()
+
+        self.assertIn('25.0%, 1.0 GiB / 4.0 GiB, 100 / 400 files, 10.0 files/s, 107.4 MB/s, ETA 0:00:20',
+                      logs.output[0])
+        self.assertIn('added 1.0 KiB, processed 2.0 KiB in 0:01:05, snapshot a1b2c3d4', logs.output[1])
+        self.assertEqual(progress.summary['files_changed'], 2)
+
+    def test_metrics_textfile(self):
+        """Phases are written atomically as a prometheus textfile"""
+        import tempfile
+        from restic_compose_backup import jobs, metrics
+        from restic_compose_backup.config import config
+
+        registry = metrics.Registry()
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(config, 'metrics_dir', tmp):
+            with registry.phase('discovery'):
+                pass
+            self.assertEqual(os.listdir(tmp), [])
+
+            registry.configure(project='myproject', role='process')
+            result = jobs.JobResult('db', 1, 2.5, summary={'data_added': 1024, 'total_files_processed': 3})
+            registry.record_job('database_backup', result, service='mysql')
+
+            self.assertEqual(os.listdir(tmp), ['restic_compose_backup_myproject_process.prom'])
+            with open(str(registry.path)) as f:
+                text = f.read()
+
+        self.assertIn('restic_compose_backup_phase_duration_seconds{project="myproject",role="process",phase="discovery"}', text)
+        self.assertIn(
+            'restic_compose_backup_phase_exit_code{project="myproject",role="process",phase="database_backup",service="mysql"} 1',
+            text,
+        )
+        self.assertIn('restic_compose_backup_phase_bytes_added{project="myproject",role="process",phase="database_backup"', text)
+        self.assertIn('# TYPE restic_compose_backup_phase_files_processed gauge', text)
+
+        # Families written by several roles are served once with the samples of all files
+        registry.configure(project='myproject', role='backup')
+        merged = metrics.merge([text, registry.render()])
+        self.assertEqual(merged.count('# HELP restic_compose_backup_phase_duration_seconds '), 1)
+        self.assertEqual(merged.count('# TYPE restic_compose_backup_phase_duration_seconds '), 1)
+        self.assertIn('phase_duration_seconds{project="myproject",role="process",phase="discovery"}', merged)
+        self.assertIn('phase_duration_seconds{project="myproject",role="backup",phase="discovery"}', merged)
+        self.assertEqual(len(merged.splitlines()), len(set(merged.splitlines())))
+
+    def test_crontab_maintenance(self):
+        """Backup, prune and check get separate crontab entries"""
+        from restic_compose_backup import cron
+        from restic_compose_backup.config import Config
+
+        config = Config()
+        config.prune_schedule = 'invalid'
+        config.check_schedule = '0 6 * * 1'
+        self.assertEqual(cron.generate_crontab(config).splitlines(), [
+            '0 2 * * * source /env.sh && rcb backup > /proc/1/fd/1',
+            '0 4 * * * source /env.sh && rcb maintenance --prune > /proc/1/fd/1',
+            '0 6 * * 1 source /env.sh && rcb maintenance --check > /proc/1/fd/1',
+            '0 6 * * 0 source /env.sh && rcb maintenance --cleanup-cache > /proc/1/fd/1',
+        ])
+
+    def test_prune_due(self):
+        """Prune is skipped until enough time passed or enough snapshots were forgotten"""
+        import time
+        from restic_compose_backup import cli, restic
+        from restic_compose_backup.config import Config
+
+        config = Config()
+        config.prune_min_hours = 24
+        config.prune_min_forgotten = 10
+        now = time.time()
+
+        self.assertTrue(cli.prune_due(config, {}))
+        self.assertTrue(cli.prune_due(config, {'last_prune': now - 25 * 3600}))
+        self.assertTrue(cli.prune_due(config, {'last_prune': now - 3600, 'forgotten_since_prune': 10}))
+        self.assertFalse(cli.prune_due(config, {'last_prune': now - 3600, 'forgotten_since_prune': 9}))
+
+        output = json.dumps([
+            {'keep': [{}, {}], 'remove': [{}, {}, {}]},
+            {'keep': [{}], 'remove': None},
+        ])
+        with mock.patch('restic_compose_backup.commands.run_output', return_value=(0, output)):
+            self.assertEqual(restic.forget('test', '7', '4', '12', '3'), (0, 3))
+
+        # The maintenance state is read and written while holding the repository lock
+        import contextlib
+        import tempfile
+        from restic_compose_backup import state
+
+        events = []
+
+        @contextlib.contextmanager
+        def repository_lock(repository, operation, exclusive=False):
+            events.append(('lock', operation))
+            yield
+            events.append(('unlock', operation))
+
+        original_save = state.State.save
+
+        def save(self):
+            events.append(('save', self.get('forgotten_since_prune')))
+            original_save(self)
+
+        from restic_compose_backup.config import config as shared_config
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(shared_config, 'state_dir', tmp), \
+                mock.patch('restic_compose_backup.lock.repository_lock', repository_lock), \
+                mock.patch.object(state.State, 'save', save), \
+                mock.patch('restic_compose_backup.restic.forget', return_value=(0, 2)), \
+                mock.patch('restic_compose_backup.restic.prune', return_value=0):
+            self.assertEqual(cli.forget_hosts(config, ['host1']), 0)
+            self.assertEqual(cli.prune_repository(config, force=True), 0)
+
+        self.assertEqual(events, [
+            ('lock', 'forget'), ('save', 4), ('unlock', 'forget'),
+            ('lock', 'prune'), ('save', 0), ('unlock', 'prune'),
+        ])
+
+    def test_check_read_data_subset(self):
+        """Rolling verification checks the next subset and persists the position"""
+        import tempfile
+        from restic_compose_backup import cli, state
+        from restic_compose_backup.config import Config, config
+
+        test_config = Config()
+        test_config.check_read_data_subsets = 3
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(config, 'state_dir', tmp), \
+                mock.patch.object(config, 'lock_dir', tmp), \
+                mock.patch('restic_compose_backup.restic.list_locks', return_value=[]), \
+                mock.patch('restic_compose_backup.restic.stats', return_value={'total_size': 300}) as stats, \
+                mock.patch('restic_compose_backup.restic.check', return_value=0) as check:
+            for _ in range(4):
+                self.assertEqual(cli.check_repository(test_config), 0)
+
+            self.assertEqual(
+                [call[1]['read_data_subset'] for call in check.call_args_list],
+                ['1/3', '2/3', '3/3', '1/3'],
+            )
+            # The repository size is only read at the start of each pass
+            self.assertEqual(stats.call_count, 2)
+            self.assertEqual(state.State('maintenance')['repository_size'], 300)
+
+            check.return_value = 1
+            self.assertEqual(cli.check_repository(test_config), 1)
+            self.assertEqual(state.State('maintenance')['check_subset'], 2)
+            self.assertEqual(stats.call_count, 2)
+
+    def test_cache_report(self):
+        """Cache hits are estimated from the files present before the run"""
+        import tempfile
+        from restic_compose_backup import cache
+
+        with tempfile.TemporaryDirectory() as tmp:
+            os.makedirs(os.path.join(tmp, 'repo', 'index'))
+            for name, size in [('config', 10), ('index/a', 100), ('index/b', 200)]:
+                with open(os.path.join(tmp, 'repo', name), 'wb') as fd:
+                    fd.write(b'0' * size)
+
+            before = cache.scan(tmp)
+            with open(os.path.join(tmp, 'repo', 'index', 'c'), 'wb') as fd:
+                fd.write(b'0' * 50)
+            report = cache.report(before, cache.scan(tmp))
+
+        self.assertEqual(report['size'], 360)
+        self.assertEqual(report['files'], 4)
+        self.assertEqual(report['downloaded_files'], 1)
+        self.assertEqual(report['downloaded_bytes'], 50)
+        self.assertEqual(report['hit_ratio'], 0.75)
+
+    def test_cache_volume(self):
+        """A named cache volume is mounted unless the backup service has one"""
+        from restic_compose_backup import cli
+        from restic_compose_backup.config import Config
+
+        config = Config()
+        containers = self.createContainers()
+        with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
+            result = RunningContainers()
+
+        self.assertEqual(cli.cache_volume(config, result), {
+            '{}_restic_cache'.format(result.project_name): {'bind': '/cache/restic', 'mode': 'rw'},
+        })
+
+        containers[0]['mounts'] = [{'Source': '/srv/cache', 'Destination': '/cache', 'Type': 'bind'}]
+        with mock.patch(list_containers_func, fixtures.containers(containers=containers)):
+            result = RunningContainers()
+
+        self.assertEqual(cli.cache_volume(config, result), {})
+
+        # Swarm services have no compose project
+        containers[0]['mounts'] = []
+        with mock.patch(list_containers_func, fixtures.containers(project='', containers=containers)):
+            result = RunningContainers()
+
+        self.assertEqual(list(cli.cache_volume(config, result)), ['restic_compose_backup_restic_cache'])
+
+        containers[0]['labels'] = {'com.docker.stack.namespace': 'stack'}
+        with mock.patch(list_containers_func, fixtures.containers(project='', containers=containers)):
+            result = RunningContainers()
+
+        self.assertEqual(list(cli.cache_volume(config, result)), ['stack_restic_cache'])
+        self.assertEqual(result.stable_name, 'stack')
+
+    def test_backup_options(self):
+        """Backups use a stable host and optionally an explicit parent snapshot"""
+        from restic_compose_backup import restic
+        from restic_compose_backup.config import config
+
+        output = json.dumps([
+            {'id': 'aaa', 'time': '2020-01-01T02:00:00.000000000Z'},
+            {'id': 'bbb', 'time': '2020-01-02T02:00:00.000000000Z'},
+        ])
+        with mock.patch.object(config, 'restic_host', 'myproject'), \
+                mock.patch.object(config, 'parent_snapshot_lookup', 'true'), \
+                mock.patch('restic_compose_backup.commands.run_output', return_value=(0, output)) as run_output:
+            self.assertEqual(
+                restic.backup_options('test', path='/volumes/web'),
+                ['--host', 'myproject', '--parent', 'bbb'],
+            )
+            self.assertEqual(restic.backup_options('test'), ['--host', 'myproject'])
+
+        args = run_output.call_args[0][0]
+        self.assertEqual(args[args.index('snapshots'):], [
+            'snapshots', '--json', '--last', '--path', '/volumes/web', '--host', 'myproject',
+        ])
+
+    def test_forget_unit(self):
+        """Forget selects the snapshots of a single unit ignoring the image tag"""
+        from restic_compose_backup import restic
+
+        tags = ['project=default', 'service=web', 'type=volume', 'image=nginx:1.17']
+        with mock.patch('restic_compose_backup.commands.run_output', return_value=(0, '[]')) as run_output:
+            self.assertEqual(restic.forget('test', '7', '4', '12', '3', tags=tags), (0, 0))
+
+        args = run_output.call_args[0][0]
+        self.assertEqual(args[args.index('forget'):args.index('--keep-daily')], [
+            'forget', '--json', '--tag', 'project=default,service=web,type=volume', '--group-by', 'host,paths',
+        ])
+
+        with mock.patch('restic_compose_backup.commands.run_output', return_value=(0, '[]')) as run_output:
+            restic.forget('test', '7', '4', '12', '3', host='worker1')
+
+        args = run_output.call_args[0][0]
+        self.assertEqual(args[args.index('forget'):args.index('--keep-daily')], [
+            'forget', '--json', '--host', 'worker1', '--group-by', 'host,paths',
+        ])
+
+        # Snapshots from before units were tagged are grouped by their paths only
+        with mock.patch('restic_compose_backup.commands.run_output', return_value=(0, '[]')) as run_output:
+            restic.forget('test', '7', '4', '12', '3', untagged=True)
+
+        args = run_output.call_args[0][0]
+        self.assertEqual(args[args.index('forget'):args.index('--keep-daily')], [
+            'forget', '--json', '--tag', '', '--group-by', 'paths',
+        ])
+
+        # Units sharing a filter are forgotten once and the project covers snapshots of removed units
+        from restic_compose_backup import cli
+        backup_plan = mock.MagicMock(project_name='default', units=[
+            {'tags': tags},
+            {'tags': tags},
+            {'tags': ['project=default', 'service=db', 'type=postgres']},
+        ])
+        with mock.patch.object(cli, 'forget_groups', return_value=0) as forget_groups:
+            cli.forget_snapshots(mock.MagicMock(), backup_plan)
+
+        self.assertEqual([restic.unit_filter(group['tags']) for group in forget_groups.call_args[0][1]], [
+            'project=default,service=web,type=volume',
+            'project=default,service=db,type=postgres',
+            'project=default',
+        ])
+
+    def test_volume_fingerprints(self):
+        """Volumes are skipped until their fingerprint changes"""
+        import tempfile
+        from restic_compose_backup import cli, fingerprint
+        from restic_compose_backup.config import Config
+
+        config = Config()
+        with tempfile.TemporaryDirectory() as tmp:
+            config.cache_dir = os.path.join(tmp, 'cache')
+            volume = os.path.join(tmp, 'volumes', 'web')
+            os.makedirs(os.path.join(volume, 'media', 'images'))
+            with open(os.path.join(volume, 'media', 'images', 'a.png'), 'wb') as fd:
+                fd.write(b'0' * 100)
+
+            first = fingerprint.scan(volume, workers=4)
+            self.assertEqual((first['files'], first['size']), (1, 100))
+            self.assertEqual(fingerprint.scan(volume, workers=1), first)
+
+            units = [{'path': volume, 'tags': []}]
+            changed, index = cli.skip_unchanged_volumes(config, units)
+            self.assertEqual(len(changed), 1)
+            index[volume] = changed[0]['fingerprint']
+            index.save()
+
+            changed, _ = cli.skip_unchanged_volumes(config, units)
+            self.assertEqual(changed, [])
+
+            os.utime(os.path.join(volume, 'media', 'images', 'a.png'), ns=(0, 0))
+            changed, _ = cli.skip_unchanged_volumes(config, units)
+            self.assertEqual(len(changed), 1)
+
+    def test_backup_log_relay(self):
+        """Output is split into lines incrementally and logs are rotated"""
+        import gzip
+        import tempfile
+        from restic_compose_backup import backup_runner
+
+        chunks = ['first line\r\nsec'.encode(), 'ond ø'.encode()[:-1], 'ond ø'.encode()[-1:] + b'\nlast', 'x' * 5]
+        self.assertEqual(
+            list(backup_runner.readlines(iter(chunks), max_length=8)),
+            ['first line', 'second ø', 'lastxxxx', 'x'],
+        )
+
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'backup.log')
+            for run in range(4):
+                with backup_runner.open_log(path, keep=3, compress=True) as fd:
+                    fd.write(f'run {run}\n')
+
+            self.assertEqual(sorted(os.listdir(tmp)), ['backup.log.1.gz', 'backup.log.2.gz', 'backup.log.gz'])
+            with gzip.open(path + '.2.gz', 'rt') as fd:
+                self.assertEqual(fd.read(), 'run 1\n')
+
+    def test_alerts_background(self):
+        """Alerts are sent concurrently with retries and flushed with a deadline"""
+        import threading
+        from restic_compose_backup import alerts
+        from restic_compose_backup.config import config
+
+        release = threading.Event()
+
+        class Flaky:
+            name = 'flaky'
+            calls = 0
+
+            def send(self, subject=None, body=None, timeout=None):
+                Flaky.calls += 1
+                if Flaky.calls < 3:
+                    raise RuntimeError('unavailable')
+
+        class Hung:
+            name = 'hung'
+
+            def send(self, subject=None, body=None, timeout=None):
+                release.wait(timeout)
+
+        with mock.patch.object(alerts, '_backends', [Flaky(), Hung()]), \
+                mock.patch.object(config, 'alert_backoff', 0), \
+                mock.patch.object(config, 'alert_timeout', 5):
+            alerts.send(subject='test', body='body', alert_type='ERROR')
+            self.assertFalse(alerts.flush(timeout=0.2))
+            self.assertEqual(Flaky.calls, 3)
+            release.set()
+            self.assertTrue(alerts.flush(timeout=5))
+
+    def test_alerts_flush_exit(self):
+        """A hung backend does not keep the process alive past the flush timeout"""
+        import subprocess
+        import sys
+        import time
+
+        script = '\n'.join([
+            'import time',
+            'from restic_compose_backup import alerts',
+            'from restic_compose_backup.config import config',
+            'class Hung:',
+            '    name = "hung"',
+            '    def send(self, subject=None, body=None, timeout=None):',
+            '        time.sleep(timeout)',
+            '        raise TimeoutError()',
+            'alerts._backends = [Hung()]',
+            'config.alert_timeout = 30',
+            'config.alert_backoff = 30',
+            'config.alert_flush_timeout = 1',
+            'alerts.send(subject="test", body="body")',
+        ])
+        start = time.monotonic()
+        subprocess.run([sys.executable, '-c', script], check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.DEVNULL, timeout=20)
+        self.assertLess(time.monotonic() - start, 5)
+
+    def test_execute_streaming(self):
+        """Both pipes are read while the command runs keeping a bounded tail"""
+        import sys
+        from restic_compose_backup import commands
+
+        script = (
+            "import sys\n"
+            "for i in range(1000):\n"
+            "    print('out', i)\n"
+            "    print('err', i, file=sys.stderr)\n"
+            "sys.exit(3)\n"
+        )
+        lines = []
+        with self.assertLogs('restic_compose_backup.commands', level='ERROR') as logs:
+            result = commands.execute([sys.executable, '-c', script], on_stdout=lines.append, tail_lines=5)
+
+        self.assertEqual(result.returncode, 3)
+        self.assertEqual(len(lines), 1000)
+        self.assertEqual(list(result.tail), ['out {}'.format(i) for i in range(995, 1000)])
+        self.assertEqual(len([line for line in logs.output if 'err' in line]), 1000)
+        self.assertGreater(result.max_rss, 0)
+        self.assertGreaterEqual(result.cpu_time, 0)
+
+        with self.assertLogs('restic_compose_backup.commands', level='ERROR'):
+            result = commands.execute([sys.executable, '-c', 'import time; time.sleep(10)'], timeout=0.5)
+        self.assertTrue(result.timed_out)
+        self.assertLess(result.duration, 5)
+        self.assertEqual(result.returncode, -9)
+
+        # Dump tools may write bytes that are not utf-8 to stderr
+        with self.assertLogs('restic_compose_backup.commands', level='ERROR') as logs:
+            commands.log_std('pg_dump', b'invalid \xff byte\n', logging.ERROR)
+        self.assertTrue(any('invalid \ufffd byte' in line for line in logs.output))
+
+    def test_backup_from_stdin_relay(self):
+        """Dumps are relayed to restic counting bytes and draining both stderr streams"""
+        import sys
+        from restic_compose_backup import restic
+
+        source = [sys.executable, '-c', (
+            "import sys\n"
+            "sys.stderr.write('dump warning\\n')\n"
+            "sys.stdout.buffer.write(b'x' * 3000000)\n"
+        )]
+        dest = [sys.executable, '-c', (
+            "import json, os, sys, time\n"
+            "size = 0\n"
+            "for chunk in iter(lambda: sys.stdin.buffer.read(65536), b''):\n"
+            "    size += len(chunk)\n"
+            "    time.sleep(0.001)\n"
+            "print(json.dumps({'message_type': 'summary', 'total_bytes_processed': size,\n"
+            "                  'fps': os.environ.get('RESTIC_PROGRESS_FPS')}))\n"
+        )]
+        with mock.patch('restic_compose_backup.restic.restic', return_value=dest), \
+                mock.patch.object(restic.config, 'progress_interval', 10), \
+                self.assertLogs('restic_compose_backup', level='INFO') as logs:
+            exit_code, summary = restic.backup_from_stdin('test', '/databases/db.sql', source, with_summary=True)
+
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(summary['total_bytes_processed'], 3000000)
+        self.assertEqual(summary['dump_bytes'], 3000000)
+        # restic only reports its status as often as progress is logged
+        self.assertEqual(summary['fps'], '0.2')
+        self.assertTrue(any('dumped 2.9 MiB' in line for line in logs.output))
+
+    def test_swarm_agents(self):
+        """Agents are pinned to nodes running labeled tasks and report the exit code of their task"""
+        from restic_compose_backup import swarm
+
+        def service(name, labels, tasks):
+            svc = mock.MagicMock()
+            svc.attrs = {'Spec': {
+                'Name': name,
+                'TaskTemplate': {
+                    'ContainerSpec': {'Labels': labels},
+                    'Networks': [{'Target': name + '_net'}],
+                },
+            }}
+            svc.tasks.return_value = [
+                {'NodeID': node, 'Status': {'State': state}} for node, state in tasks
+            ]
+            return svc
+
+        nodes = []
+        for node_id, hostname in [('n1', 'worker1'), ('n2', 'worker2')]:
+            node = mock.MagicMock(id=node_id)
+            node.attrs = {'Description': {'Hostname': hostname}}
+            nodes.append(node)
+
+        client = mock.MagicMock()
+        client.services.list.return_value = [
+            service('db', {'restic-compose-backup.postgres': 'true'}, [('n1', 'running'), ('n2', 'shutdown')]),
+            service('web', {'restic-compose-backup.volumes': 'true'}, [('n1', 'running'), ('n2', 'running')]),
+            service('cache', {'other': 'true'}, [('n1', 'running')]),
+        ]
+        with mock.patch('restic_compose_backup.utils.docker_client', return_value=client), \
+                mock.patch('restic_compose_backup.utils.get_swarm_nodes', return_value=nodes):
+            found = swarm.find_nodes()
+
+        self.assertEqual([node.hostname for node in found], ['worker1', 'worker2'])
+        self.assertEqual(found[0].services, {'db', 'web'})
+        self.assertEqual(found[0].networks, {'db_net', 'web_net'})
+        self.assertEqual(found[1].services, {'web'})
+
+        agent = mock.MagicMock()
+        agent.tasks.return_value = [{'Status': {'State': 'failed', 'Err': 'task: non-zero exit (3)',
+                                                'ContainerStatus': {'ExitCode': 3}}}]
+        agent.logs.return_value = iter([b'backup output\n'])
+        client.services.create.return_value = agent
+        from restic_compose_backup.containers import Mount
+        mounts = [
+            Mount({'Type': 'bind', 'Source': '/var/run/docker.sock', 'Destination': '/tmp/docker.sock'}),
+            Mount({'Type': 'volume', 'Name': 'cache', 'Source': '/var/lib/docker/volumes/cache/_data',
+                   'Destination': '/cache'}),
+            Mount({'Type': 'bind', 'Source': '/srv/backup', 'Destination': '/srv'}),
+        ]
+        with mock.patch('restic_compose_backup.utils.docker_client', return_value=client), \
+                self.assertLogs('restic_compose_backup.swarm', level='INFO') as logs:
+            exit_code = swarm.run_agent(found[1], 'rcb', ['HOSTNAME=abc', 'RESTIC_REPOSITORY=test'], mounts)
+
+        self.assertEqual(exit_code, 3)
+        args, kwargs = client.services.create.call_args
+        self.assertEqual(kwargs['constraints'], ['node.id==n2'])
+        self.assertEqual(kwargs['command'], ['rcb', 'backup', '--no-forget'])
+        self.assertEqual(kwargs['env'], ['RESTIC_REPOSITORY=test', 'RESTIC_HOST=worker2'])
+        # Host paths other than the docker socket may not exist on the node
+        self.assertEqual([(m['Type'], m['Source'], m['Target']) for m in kwargs['mounts']], [
+            ('bind', '/var/run/docker.sock', '/tmp/docker.sock'),
+            ('volume', 'cache', '/cache'),
+        ])
+        self.assertEqual(kwargs['networks'], ['web_net'])
+        self.assertTrue(any('backup output' in line for line in logs.output))
+        agent.remove.assert_called_once()
+
+        # Agents not finishing in time are removed so they stop running
+        agent.reset_mock()
+        agent.tasks.return_value = [{'Status': {'State': 'running'}}]
+        with mock.patch('restic_compose_backup.utils.docker_client', return_value=client), \
+                mock.patch.object(swarm.config, 'swarm_agent_timeout', 0):
+            self.assertEqual(swarm.run_agent(found[1], 'rcb', [], mounts), 1)
+        agent.remove.assert_called_once()
+        agent.logs.assert_not_called()
+
+        # Forget runs once for the hosts of successful agents after all of them finished
+        from restic_compose_backup import cli
+        from restic_compose_backup.config import Config
+
+        calls = []
+        containers = mock.MagicMock()
+        test_config = Config()
+        test_config.restic_host = None
+        with mock.patch('restic_compose_backup.utils.get_swarm_nodes', return_value=nodes), \
+                mock.patch.object(swarm, 'list_agents', return_value=[]), \
+                mock.patch.object(swarm, 'find_nodes', return_value=found), \
+                mock.patch.object(swarm, 'run_agent', side_effect=lambda node, **kwargs: calls.append(node) or (
+                    0 if node.hostname == 'worker1' else 1)), \
+                mock.patch.object(cli, 'init_repository'), \
+                mock.patch.object(cli, 'forget_hosts', side_effect=lambda config, hosts: calls.append(hosts) or 0), \
+                mock.patch('restic_compose_backup.alerts.send'), \
+                self.assertRaises(SystemExit):
+            cli.swarm_backup(test_config, containers)
+
+        self.assertCountEqual(calls[:2], found)
+        self.assertEqual(calls[2:], [['worker1']])
+
+    def test_repository_lock(self):
+        """Backups share the repository lock while exclusive operations queue for it"""
+        import tempfile
+        import threading
+        from restic_compose_backup import lock, metrics
+        from restic_compose_backup.config import config
+
+        events = []
+        with tempfile.TemporaryDirectory() as tmp, mock.patch.object(config, 'lock_dir', tmp), \
+                mock.patch.object(config, 'lock_timeout', 5), \
+                mock.patch.object(lock, 'POLL_INTERVAL', 0.01), \
+                mock.patch('restic_compose_backup.restic.list_locks', side_effect=[['a', 'b'], ['b'], [], [], []]), \
+                mock.patch('restic_compose_backup.restic.unlock', return_value=0) as unlock:
+
+            def run(operation, exclusive, started, release):
+                with lock.repository_lock('repo', operation, exclusive=exclusive):
+                    events.append(operation)
+                    started.set()
+                    release.wait(5)
+
+            threads, started, release = {}, {}, {}
+            for name, exclusive in [('backup1', False), ('backup2', False), ('prune', True), ('backup3', False)]:
+                started[name], release[name] = threading.Event(), threading.Event()
+                threads[name] = threading.Thread(target=run, args=(name, exclusive, started[name], release[name]))
+                threads[name].start()
+                started[name].wait(0.5)
+
+            # The prune waits for both backups and the last backup waits for the prune
+            self.assertEqual(events, ['backup1', 'backup2'])
+            release['backup1'].set()
+            release['backup2'].set()
+            self.assertTrue(started['prune'].wait(5))
+            self.assertFalse(started['backup3'].wait(0.2))
+            release['prune'].set()
+            self.assertTrue(started['backup3'].wait(5))
+            release['backup3'].set()
+            for thread in threads.values():
+                thread.join(5)
+
+            self.assertEqual(events, ['backup1', 'backup2', 'prune', 'backup3'])
+            unlock.assert_called_once_with('repo')
+            self.assertIn(('lock_wait_seconds', (('mode', 'exclusive'), ('operation', 'prune'))),
+                          metrics.registry._samples)
+
+            # Exclusive operations time out while a backup holds the lock
+            with mock.patch.object(config, 'lock_timeout', 0.1), \
+                    mock.patch('restic_compose_backup.restic.list_locks', return_value=[]):
+                with lock.repository_lock('repo', 'backup'):
+                    with self.assertRaises(TimeoutError):
+                        with lock.repository_lock('repo', 'check', exclusive=True):
+                            pass
+
+    def test_jobs_command_output_grouped(self):
+        """Output logged by the reader threads of commands stays grouped with its job"""
+        import logging
+        import sys
+        from restic_compose_backup import commands, jobs, log
+
+        messages = []
+
+        class Collect(logging.Handler):
+            def emit(self, record):
+                messages.append(record.getMessage())
+
+        handler = Collect()
+        handler.addFilter(log.CaptureFilter())
+        logger = logging.getLogger('restic_compose_backup')
+        level = logger.level
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+
+        def job(name):
+            script = (
+                "import sys, time\n"
+                "for i in range(20):\n"
+                "    print('{} err', i, file=sys.stderr, flush=True)\n"
+                "    time.sleep(0.005)\n"
+            ).format(name)
+            return jobs.Job(name, lambda: commands.run([sys.executable, '-c', script]))
+
+        try:
+            results = jobs.run([job('first'), job('second')], concurrency=2)
+        finally:
+            logger.removeHandler(handler)
+            logger.setLevel(level)
+
+        self.assertEqual([result.exit_code for result in results], [0, 0])
+        owners = [message.split()[0] for message in messages if ' err ' in message]
+        self.assertEqual(len(owners), 40)
+        # Each job's lines are written in one block
+        self.assertEqual(sum(1 for a, b in zip(owners, owners[1:]) if a != b), 1)